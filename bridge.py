@@ -0,0 +1,62 @@
+# Polls one C6 controller and shares the values with local consumers (plugin option bridge=1, scripts),
+# all writes are serialized through this single Modbus client
+import argparse
+import logging
+import signal
+import sys
+import threading
+
+from komfovent import BRIDGE_PORT, BridgeServer, CircuitBreaker, ClockSync, ModbusSession, Poller, ReadPlan
+from komfovent import find_sections, parse_intervals, plan_points
+
+
+def endpoint(text, port):
+    host, _, value = text.rpartition(':')
+    return (host, int(value)) if host else (text, port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share one Komfovent C6 controller with several local clients')
+    parser.add_argument('address', help='controller host[:port]')
+    parser.add_argument('--listen', default='127.0.0.1:%d' % BRIDGE_PORT,
+                        help='bridge host:port, default 127.0.0.1:%d' % BRIDGE_PORT)
+    parser.add_argument('--timeout', type=float, default=3.0, help='Modbus timeout in seconds')
+    parser.add_argument('--intervals', default='', help='poll intervals as group:min-max,...')
+    parser.add_argument('--sections', default='', help="installed sections, comma separated or 'all', "
+                                                        "probed when empty")
+    parser.add_argument('--sync-time', action='store_true', help='keep the controller clock in sync')
+    parser.add_argument('--serial', action='store_true', help='wait for every answer instead of pipelining')
+    parser.add_argument('--debounce', type=float, default=0.5, help='seconds to coalesce writes')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    log = logging.getLogger('bridge')
+
+    host, port = endpoint(args.address, 502)
+    session = ModbusSession(host, port=port, timeout=args.timeout, log=log.debug, breaker=CircuitBreaker(),
+                            pipelining=not args.serial)
+    sections = find_sections(session, args.sections, log=log.info, error=log.error)[0]
+    plan = ReadPlan(plan_points(sections, args.sync_time))
+    log.info('Read plan: %s', plan)
+    clock = ClockSync() if args.sync_time else None
+    poller = Poller(session, plan, parse_intervals(args.intervals), clock, args.debounce, log=log.error)
+    server = BridgeServer(poller, *endpoint(args.listen, BRIDGE_PORT), log=log.info)
+
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopped.set())
+    poller.start()
+    server.start()
+    log.info('Bridge for %s listening on %s:%d', session, *server.address)
+    while not stopped.wait(1):
+        pass
+
+    server.stop()
+    poller.stop()
+    session.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
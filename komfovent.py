@@ -0,0 +1,1318 @@
+# Komfovent C6 Modbus helpers shared by the Domoticz plugin
+import collections
+import datetime
+import json
+import mmap
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+from pymodbus.factory import ClientDecoder
+
+
+def _no_log(message):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after threshold consecutive transport failures. While open, transactions fail at once
+    # without touching the network until the backoff has passed, then a single probe is let through.
+    # A failed probe doubles the backoff up to max_backoff, a success closes the breaker.
+
+    def __init__(self, threshold=3, backoff=5, max_backoff=300):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.delay = backoff
+        self.open_until = 0.0
+
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def allow(self, now):
+        return not self.is_open() or now >= self.open_until
+
+    def success(self):
+        self.failures = 0
+        self.delay = self.backoff
+
+    def failure(self, now):
+        self.failures += 1
+        if self.is_open():
+            self.open_until = now + self.delay
+            self.delay = min(self.delay * 2, self.max_backoff)
+
+
+class ModbusSession:
+    # Long-lived Modbus TCP session. The socket is opened on first use and kept
+    # open between transactions. A socket that has been idle for longer than
+    # idle_timeout is assumed to be dropped by the controller and is recycled
+    # before use. A transaction failing on transport level is retried once on
+    # a fresh connection, unless the circuit breaker is open.
+    # With pipelining, execute_all sends a batch of requests back to back and
+    # matches the answers by transaction id, so the batch takes about one round
+    # trip. A batch whose answers go missing is retried serially, a controller
+    # that answers serially but failed PIPELINE_RETRIES pipelined batches in a
+    # row, without ever completing one, is used serially from then on.
+
+    PIPELINE_RETRIES = 3
+    MBAP = struct.Struct('>HHHB')  # transaction id, protocol, length, unit
+    UNIT = 0                       # pymodbus default unit id
+    REQUESTS = {
+        'read_holding_registers': lambda address, count: struct.pack('>BHH', 3, address, count),
+        'write_register': lambda address, value: struct.pack('>BHH', 6, address, value),
+        'write_registers': lambda address, values: struct.pack('>BHHB%dH' % len(values), 16, address, len(values),
+                                                               2 * len(values), *values),
+        }
+
+    def __init__(self, host, port=502, timeout=3, idle_timeout=60, log=None, metrics=None, breaker=None,
+                 pipelining=False):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.log = log or _no_log
+        self.client = ModbusTcpClient(host, port=port, timeout=timeout)
+        self.last_used = 0.0
+        self.connects = 0
+        self.metrics = metrics
+        self.breaker = breaker or CircuitBreaker()
+        self.pipelining = pipelining
+        self.pipelined = False
+        self.pipeline_failures = 0
+        self.decoder = ClientDecoder()
+        # The client may be used from several threads
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return str(self.host) + ':' + str(self.port)
+
+    def is_open(self):
+        return self.client.is_socket_open()
+
+    def connect(self):
+        if self.is_open():
+            if not self.idle_timeout or time.monotonic() - self.last_used < self.idle_timeout:
+                return True
+            self.log('Modbus session to ' + str(self) + ' idle, reconnecting.')
+            self.client.close()
+
+        if not self.client.connect():
+            self.log('Unable to connect to ' + str(self) + '.')
+            return False
+        self.connects += 1
+        if self.metrics is not None:
+            self.metrics.count('connects')
+        self.last_used = time.monotonic()
+        return True
+
+    def close(self):
+        with self.lock:
+            self.client.close()
+
+    def execute(self, method, *args, **kwargs):
+        with self.lock:
+            return self._execute(method, *args, **kwargs)
+
+    def _execute(self, method, *args, **kwargs):
+        if not self.breaker.allow(time.monotonic()):
+            return ModbusIOException('Circuit to ' + str(self) + ' open')
+        result = None
+        for attempt in range(1 if self.breaker.is_open() else 2):
+            if not self.connect():
+                result = ModbusIOException('Unable to connect to ' + str(self))
+                break
+            start = time.perf_counter()
+            try:
+                result = getattr(self.client, method)(*args, **kwargs)
+            except ConnectionException as e:
+                result = ModbusIOException(str(e))
+            self.last_used = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.observe(method, time.perf_counter() - start)
+                self.metrics.observe('errors', 1 if result.isError() else 0)
+
+            # Exception responses come from a healthy connection, only transport errors need a new socket
+            if not isinstance(result, ModbusIOException):
+                if self.breaker.is_open():
+                    self.log('Modbus session to ' + str(self) + ' recovered.')
+                self.breaker.success()
+                return result
+            self.log('Modbus ' + method + ' on ' + str(self) + ' failed: ' + str(result))
+            self.client.close()
+
+        self._failure()
+        return result
+
+    def _failure(self):
+        was_open = self.breaker.is_open()
+        self.breaker.failure(time.monotonic())
+        if self.breaker.is_open() and not was_open:
+            self.log('Modbus session to ' + str(self) + ' failing, backing off.')
+
+    def execute_all(self, requests):
+        # [(method, args)] -> results in the same order
+        with self.lock:
+            if not self.pipelining or len(requests) < 2 or self.breaker.is_open():
+                return [self._execute(method, *args) for method, args in requests]
+            if not self.connect():
+                # Unreachable, a serial retry would only wait for the connect timeout again
+                self._failure()
+                return [ModbusIOException('Unable to connect to ' + str(self)) for request in requests]
+            results = self._pipeline(requests)
+            if results is not None:
+                self.pipelined = True
+                self.pipeline_failures = 0
+                return results
+
+            results = [self._execute(method, *args) for method, args in requests]
+            # Only a controller that answers the same requests serially counts against pipelining
+            if not self.pipelined and not any(isinstance(result, ModbusIOException) for result in results):
+                self.pipeline_failures += 1
+                if self.pipeline_failures >= self.PIPELINE_RETRIES:
+                    self.pipelining = False
+                    self.log('Controller ' + str(self) + ' does not answer pipelined requests, using serial mode.')
+            return results
+
+    def _pipeline(self, requests):
+        # None when answers went missing, the caller then retries the batch serially
+        pending = {}
+        frames = []
+        for index, (method, args) in enumerate(requests):
+            pdu = self.REQUESTS[method](*args)
+            transaction = self.client.transaction.getNextTID()
+            frames.append(self.MBAP.pack(transaction, 0, len(pdu) + 1, self.UNIT) + pdu)
+            pending[transaction] = index
+
+        results = [None] * len(requests)
+        start = time.perf_counter()
+        connection = self.client.socket
+        # Serial pymodbus transactions leave the socket non-blocking
+        connection.settimeout(self.client.timeout)
+        try:
+            connection.sendall(b''.join(frames))
+            while pending:
+                transaction, protocol, length, unit = self.MBAP.unpack(_receive(connection, self.MBAP.size))
+                if length < 2:
+                    raise ModbusIOException('Invalid frame length ' + str(length))
+                pdu = _receive(connection, length - 1)
+                # Late answers of an abandoned transaction are skipped
+                index = pending.pop(transaction, None)
+                if index is None:
+                    continue
+                results[index] = self.decoder.decode(pdu)
+                if results[index] is None:
+                    raise ModbusIOException('Unable to decode function code ' + str(pdu[0]))
+                if self.metrics is not None:
+                    self.metrics.observe(requests[index][0], time.perf_counter() - start)
+                    self.metrics.observe('errors', 1 if results[index].isError() else 0)
+        except (OSError, ModbusException) as e:
+            self.log('Pipelined transactions on ' + str(self) + ' failed: ' + str(e))
+            self.client.close()
+            return None
+        self.last_used = time.monotonic()
+        self.breaker.success()
+        return results
+
+    def read_holding_registers(self, address, count):
+        return self.execute('read_holding_registers', address, count)
+
+    def write_register(self, address, value):
+        return self.execute('write_register', address, value)
+
+    def write_registers(self, address, values):
+        return self.execute('write_registers', address, values)
+
+
+class Metrics:
+    # Rolling window of the latest samples per name, e.g. transaction latencies in seconds
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counters = {}
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.window)
+            self.samples[name].append(value)
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def percentile(self, name, share):
+        with self.lock:
+            samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(share * len(samples)))]
+
+    def mean(self, name):
+        with self.lock:
+            samples = list(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return sum(samples) / float(len(samples))
+
+    def report(self):
+        # Text summary, latencies in milliseconds
+        lines = []
+        with self.lock:
+            samples = dict((name, sorted(values)) for name, values in self.samples.items())
+            counters = dict(self.counters)
+        for name in sorted(samples):
+            values = samples[name]
+            if not values:
+                continue
+            if name == 'errors':
+                lines.append('error_rate ' + '%.4f' % (sum(values) / float(len(values))))
+                continue
+            line = name + ' count=' + str(len(values))
+            for label, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                line += ' ' + label + '=' + '%.1f' % (values[min(len(values) - 1, int(share * len(values)))] * 1000)
+            lines.append(line + ' max=' + '%.1f' % (values[-1] * 1000) + ' ms')
+        for name in sorted(counters):
+            lines.append(name + ' ' + str(counters[name]))
+        return '\n'.join(lines) + '\n'
+
+
+# A single value in the controller's holding registers. Decoded value is raw * scale + offset,
+# unit names the BasePlugin.UNITS entry the value is published to (None for internal values).
+# Points of an optional section (see SECTIONS) are only read when the section is installed.
+Point = collections.namedtuple('Point', ['name', 'address', 'type', 'scale', 'offset', 'unit', 'group', 'section'],
+                               defaults=('u16', 1, 0, None, 'status', None))
+
+WIDTHS = {'u16': 1, 's16': 1, 'u32': 2}
+FORMATS = {'u16': 'H', 's16': 'h', 'u32': 'I'}
+
+REGISTER_MAP = [
+    Point('OnOff', 0, unit='OnOff'),
+    Point('ECO', 2, unit='ECO'),
+    Point('Auto', 3, unit='Auto'),
+    Point('Mode', 4, scale=10, unit='Mode'),
+    Point('TempControlType', 10, scale=10, offset=10, unit='TempControlType'),
+
+    Point('ClockTime', 28, group='clock'),      # hour << 8 | minute
+    Point('ClockYear', 29, group='clock'),
+    Point('ClockDate', 30, group='clock'),      # month << 8 | day
+
+    Point('SupplyTemp', 901, 's16', 0.1, unit='SupplyTemp', group='monitoring'),
+    Point('ExtractTemp', 902, 's16', 0.1, unit='ExtractTemp', group='monitoring'),
+    Point('OutdoorTemp', 903, 's16', 0.1, unit='OutdoorTemp', group='monitoring'),
+    Point('WaterTemp', 904, 's16', 0.1, unit='WaterTemp', group='monitoring'),
+    Point('SupplyFanIntensivity', 909, 's16', 0.1, unit='SupplyFanIntensivity', group='monitoring'),
+    Point('ExtractFanIntensivity', 910, 's16', 0.1, unit='ExtractFanIntensivity', group='monitoring'),
+    Point('HeatExchanger', 911, 's16', 0.1, unit='HeatExchanger', group='monitoring'),
+    Point('ElectricHeater', 912, 's16', 0.1, unit='ElectricHeater', group='monitoring'),
+    Point('WaterHeater', 913, 's16', 0.1, unit='WaterHeater', group='monitoring', section='water_heater'),
+    Point('WaterCooler', 914, 's16', 0.1, unit='WaterCooler', group='monitoring', section='water_cooler'),
+    Point('DXUnit', 915, 's16', 0.1, unit='DXUnit', group='monitoring', section='dx_unit'),
+    Point('FiltersImupurity', 916, scale=1.0, unit='FiltersImupurity', group='filters'),
+    Point('CurrentPowerConsumption', 920, group='monitoring'),
+    Point('CurrentHeaterPower', 921, group='monitoring'),
+    Point('CurrentHeatRecovery', 922, group='monitoring'),
+    Point('CurrentExchangeEfficiency', 923, unit='CurrentExchangeEfficiency', group='monitoring'),
+    Point('CurrentEnergySaving', 924, unit='CurrentEnergySaving', group='monitoring'),
+    Point('TotalEnergyConsumtion', 930, 'u32', unit='TotalEnergyConsumtion', group='energy'),
+    Point('TotalHeaterConsumtion', 936, 'u32', unit='TotalHeaterConsumtion', group='energy'),
+    Point('TotalEnergyRecovered', 942, 'u32', unit='TotalEnergyRecovered', group='energy'),
+    Point('Temp', 945, 's16', 0.1, unit='Temp', group='monitoring'),
+    Point('Hum', 946, unit='Hum', group='monitoring'),
+    ]
+
+
+# Optional equipment and the register probed to detect it, with the value the controller reports
+# when the equipment is missing. A section is also taken as missing when the controller rejects the
+# register. A water heater needs the water temperature sensor, which reads 0x8000 when not connected.
+# The cooler and DX unit outputs read 0 % when idle as well as when not installed, so they cannot be probed and are
+# assumed installed unless the sections option leaves them out.
+SECTIONS = {
+    'water_heater': (904, 0x8000),
+    'water_cooler': None,
+    'dx_unit': None,
+    }
+
+
+def probe_sections(session, sections=SECTIONS):
+    # Names of the installed sections, None when the controller could not be asked
+    present = []
+    for name, probe in sorted(sections.items()):
+        if probe is None:
+            present.append(name)
+            continue
+        address, missing = probe
+        result = session.read_holding_registers(address, 1)
+        if isinstance(result, ModbusIOException):
+            return None
+        if not result.isError() and result.registers[0] != missing:
+            present.append(name)
+    return present
+
+
+def parse_sections(text):
+    # "water_heater,dx_unit" or "all" -> section names, None when empty
+    text = text.strip()
+    if not text:
+        return None
+    if text == 'all':
+        return list(SECTIONS)
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def find_sections(session, text='', capabilities=None, reprobe=False, log=None, error=None):
+    # Sections listed in text, else cached in capabilities, else probed and added to capabilities.
+    # Returns (sections, probed), all sections when the controller could not be probed.
+    sections = parse_sections(text)
+    if sections is not None:
+        return sections, False
+    if capabilities is not None and str(session) in capabilities and not reprobe:
+        return capabilities[str(session)], False
+    sections = probe_sections(session)
+    if sections is None:
+        (error or _no_log)('Unable to probe ' + str(session) + ', assuming all sections installed.')
+        return list(SECTIONS), False
+    (log or _no_log)('Controller ' + str(session) + ' sections: ' + ', '.join(sections) + ' (' +
+                     ', '.join(name for name in sorted(SECTIONS) if SECTIONS[name] is None) +
+                     ' cannot be probed, set the sections option if missing)')
+    if capabilities is not None:
+        capabilities[str(session)] = sections
+    return sections, True
+
+
+def plan_points(sections, clock=False):
+    # REGISTER_MAP points of the installed sections, the clock registers only when the clock is synced
+    return [p for p in REGISTER_MAP if (p.group != 'clock' or clock) and (p.section is None or p.section in sections)]
+
+
+def load_capabilities(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_capabilities(path, capabilities):
+    with open(path, 'w') as f:
+        json.dump(capabilities, f, indent=1, sort_keys=True)
+
+
+# Poll interval bounds in seconds per group. A group is read at its minimum interval while its values
+# change and the interval grows towards the maximum while they stay the same. The session is reused only
+# while it was idle for less than idle_timeout (60 s), so the most frequent group stays below that.
+POLL_INTERVALS = {
+    'status': (10, 50),
+    'monitoring': (10, 50),
+    'energy': (60, 600),
+    'filters': (600, 3600),
+    }
+
+
+def parse_intervals(text, defaults=POLL_INTERVALS):
+    # "group:min-max,group:min-max" -> POLL_INTERVALS like dict
+    intervals = dict(defaults)
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        group, bounds = item.split(':', 1)
+        low, high = bounds.split('-', 1)
+        intervals[group.strip()] = (float(low), max(float(low), float(high)))
+    return intervals
+
+
+def plan_reads(points, max_gap=8, max_count=125, known=()):
+    # Merge points into the fewest (address, count) block reads. Two points share a block when the block
+    # stays within max_count registers and no more than max_gap consecutive registers between them are
+    # unused. Registers in known belong to other mapped points and are safe to read along.
+    known = set(known)
+    blocks = []
+    for point in sorted(points, key=lambda p: p.address):
+        end = point.address + WIDTHS[point.type]
+        if blocks and end - blocks[-1][0] <= max_count and \
+                _longest_gap(blocks[-1][1], point.address, known) <= max_gap:
+            blocks[-1][1] = max(blocks[-1][1], end)
+        else:
+            blocks.append([point.address, end])
+    return [(start, end - start) for start, end in blocks]
+
+
+def _longest_gap(start, end, known):
+    longest = run = 0
+    for address in range(start, end):
+        run = 0 if address in known else run + 1
+        longest = max(longest, run)
+    return longest
+
+
+class BlockDecoder:
+    # Decodes one register block with a struct layout compiled once: every point is a big-endian field,
+    # registers between points are padding. The packed bytes of the previous read are kept and an
+    # identical block returns the previous values without unpacking.
+
+    def __init__(self, start, count, points):
+        fields = sorted((p for p in points if start <= p.address and p.address + WIDTHS[p.type] <= start + count),
+                        key=lambda p: p.address)
+        layout = '>'
+        position = start
+        self.fields = []
+        for point in fields:
+            if point.address < position:
+                continue
+            if point.address > position:
+                layout += str(2 * (point.address - position)) + 'x'
+            layout += FORMATS[point.type]
+            position = point.address + WIDTHS[point.type]
+            self.fields.append((point.name, point.scale, point.offset))
+        self.layout = struct.Struct(layout)
+        self.words = struct.Struct('>' + str(count) + 'H')
+        self.buffer = bytearray(self.words.size)
+        self.previous = None
+        self.values = {}
+
+    def decode(self, registers):
+        # Returns (values, changed), values is shared with the next unchanged call and must not be modified
+        self.words.pack_into(self.buffer, 0, *registers)
+        if self.buffer == self.previous:
+            return self.values, False
+        if self.previous is None:
+            self.previous = bytearray(self.words.size)
+        self.buffer, self.previous = self.previous, self.buffer
+        values = {}
+        for (name, scale, offset), raw in zip(self.fields, self.layout.unpack_from(memoryview(self.previous))):
+            value = raw * scale + offset
+            values[name] = round(value, 6) if isinstance(value, float) else value
+        self.values = values
+        return values, True
+
+
+class ReadPlan:
+    # Block reads for a set of points, precomputed per combination of due groups
+
+    def __init__(self, points, max_gap=8, max_count=125):
+        self.points = list(points)
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.known = set()
+        for point in self.points:
+            self.known.update(range(point.address, point.address + WIDTHS[point.type]))
+        self.groups = sorted(set(p.group for p in self.points))
+        self.cache = {}
+        self.decoders = {}
+        self.blocks = self.blocks_for(self.groups)
+
+    def __str__(self):
+        return str(len(self.blocks)) + ' transaction(s): ' + \
+            ', '.join(str(start) + '+' + str(count) for start, count in self.blocks)
+
+    def blocks_for(self, groups):
+        key = frozenset(groups)
+        if key not in self.cache:
+            points = [p for p in self.points if p.group in key]
+            self.cache[key] = plan_reads(points, self.max_gap, self.max_count, self.known)
+        return self.cache[key]
+
+    def decode(self, start, registers):
+        # Every point inside the block is decoded, including points of groups that were not due.
+        # Returns (values, changed), changed is False when the block is identical to its last read.
+        key = (start, len(registers))
+        if key not in self.decoders:
+            self.decoders[key] = BlockDecoder(start, len(registers), self.points)
+        return self.decoders[key].decode(registers)
+
+    def read(self, session, groups=None, capture=None):
+        # Returns (values, changed) of all blocks read successfully, raw blocks go to capture if given
+        values = {}
+        changed = False
+        timestamp = time.time()
+        blocks = self.blocks_for(self.groups if groups is None else groups)
+        results = session.execute_all([('read_holding_registers', block) for block in blocks])
+        for (start, count), result in zip(blocks, results):
+            if not result.isError():
+                decoded, block_changed = self.decode(start, result.registers)
+                values.update(decoded)
+                changed = changed or block_changed
+                if capture is not None:
+                    capture.write(timestamp, start, result.registers)
+        return values, changed
+
+    def groups_at(self, address):
+        return set(p.group for p in self.points if p.address <= address < p.address + WIDTHS[p.type])
+
+
+class Scheduler:
+    # Adaptive per group poll intervals, see POLL_INTERVALS
+
+    def __init__(self, groups, intervals=POLL_INTERVALS, backoff=1.5):
+        self.intervals = dict((group, intervals.get(group, POLL_INTERVALS['status'])) for group in groups)
+        self.backoff = backoff
+        self.current = dict((group, bounds[0]) for group, bounds in self.intervals.items())
+        self.next_due = dict((group, 0.0) for group in self.intervals)
+
+    def due(self, now):
+        return [group for group, due in self.next_due.items() if due <= now]
+
+    def next_time(self):
+        return min(self.next_due.values())
+
+    def observe(self, group, changed, now):
+        low, high = self.intervals[group]
+        if changed:
+            self.current[group] = low
+        else:
+            self.current[group] = min(self.current[group] * self.backoff, high)
+        self.next_due[group] = now + self.current[group]
+
+    def failed(self, group, now):
+        self.next_due[group] = now + self.intervals[group][0]
+
+    def trigger(self, groups, now):
+        # Read the groups right away and at their fastest rate afterwards, e.g. after a write
+        for group in groups:
+            if group in self.intervals:
+                self.current[group] = self.intervals[group][0]
+                self.next_due[group] = now
+
+
+class ClockSync:
+    # Keeps the controller clock in line with local time at the cost of a rare clock read. The drift rate
+    # is estimated from the offset found at a check and the time since the last sync, the next correction
+    # is scheduled from that estimate without reading the clock. A correction is a single write of
+    # registers 28-30 sent right after a minute boundary, as the controller only keeps hours and minutes.
+    # A failed write is retried at the next minute boundary, after MAX_ATTEMPTS failures the correction
+    # waits for the next check.
+
+    NAMES = ('ClockTime', 'ClockYear', 'ClockDate')
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, check_interval=21600, verify_delay=120):
+        self.check_interval = check_interval
+        self.verify_delay = verify_delay
+        self.next_check = 0.0
+        self.last_sync = None
+        self.rate = None
+        self.pending = False
+        self.failures = 0
+        self.retry_at = 0.0
+        self.utc_offset = _utc_offset()
+
+    def check_due(self, now):
+        return not self.pending and now >= self.next_check
+
+    def observe(self, values, local, now):
+        # Offset of the controller clock in whole minutes, local time rounded down to the minute as well
+        try:
+            controller = datetime.datetime(values['ClockYear'], values['ClockDate'] >> 8, values['ClockDate'] & 0xFF,
+                                           values['ClockTime'] >> 8, values['ClockTime'] & 0xFF)
+            offset = (controller - local.replace(second=0, microsecond=0)).total_seconds()
+        except ValueError:
+            offset = None
+
+        self.next_check = now + self.check_interval
+        if offset == 0:
+            if self.last_sync is None:
+                self.last_sync = now
+            return offset
+        if offset is not None and self.last_sync is not None and now > self.last_sync:
+            self.rate = offset / (now - self.last_sync)
+        self.pending = True
+        return offset
+
+    def next_time(self, now, local):
+        if self.pending:
+            if local.second < 2 and now >= self.retry_at:
+                return now
+            return now + 60.2 - local.second - local.microsecond / 1e6
+        next_time = self.next_check
+        if self.rate and self.last_sync is not None:
+            # Correct when the estimated offset reaches half a minute
+            next_time = min(next_time, max(self.last_sync + 30 / abs(self.rate), self.retry_at))
+        return next_time
+
+    def correction(self, now, local):
+        # Registers 28-30 to write now, or None
+        if _utc_offset() != self.utc_offset:
+            # Daylight saving time switch, the drift estimate does not cover it
+            self.utc_offset = _utc_offset()
+            self.rate = None
+            self.last_sync = None
+            self.pending = True
+        if not self.pending and self.rate and self.last_sync is not None and now >= self.retry_at and \
+                abs(self.rate * (now - self.last_sync)) >= 30:
+            self.pending = True
+        if not self.pending or local.second >= 2 or now < self.retry_at:
+            return None
+        return [local.hour << 8 | local.minute, local.year, local.month << 8 | local.day]
+
+    def failed(self, now):
+        # Returns True when the correction is given up until the next check
+        self.failures += 1
+        if self.failures < self.MAX_ATTEMPTS:
+            # Past the write window of this minute
+            self.retry_at = now + 2
+            return False
+        self.failures = 0
+        self.pending = False
+        self.next_check = self.retry_at = now + self.check_interval
+        return True
+
+    def synced(self, now):
+        self.pending = False
+        self.failures = 0
+        self.last_sync = now
+        # Read the clock back once to confirm the write
+        self.next_check = now + self.verify_delay
+
+
+def _utc_offset():
+    return time.localtime().tm_gmtoff
+
+
+class CommandQueue:
+    # Pending register writes. Repeated writes to a register within debounce seconds replace each other,
+    # a write is released once its register has been left alone for debounce seconds. Released writes to
+    # adjacent registers are combined into one (address, values) run.
+
+    def __init__(self, debounce=0.5):
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.pending = {}  # address -> (value, time of the last put)
+
+    def put(self, address, value, now=None):
+        with self.lock:
+            self.pending[address] = (value, time.monotonic() if now is None else now)
+
+    def addresses(self):
+        with self.lock:
+            return set(self.pending)
+
+    def next_time(self):
+        with self.lock:
+            if not self.pending:
+                return None
+            return min(queued for value, queued in self.pending.values()) + self.debounce
+
+    def ready(self, now):
+        with self.lock:
+            addresses = sorted(a for a, (value, queued) in self.pending.items() if queued + self.debounce <= now)
+            runs = []
+            for address in addresses:
+                value = self.pending.pop(address)[0]
+                if runs and runs[-1][0] + len(runs[-1][1]) == address:
+                    runs[-1][1].append(value)
+                else:
+                    runs.append((address, [value]))
+            return runs
+
+
+class SampleRing:
+    # Fixed size ring of timestamped samples of a few channels, stored as float64 timestamps and float32
+    # values in one buffer. With path the buffer is a memory mapped file, so samples survive a restart.
+
+    HEADER = struct.Struct('<4sIIII4x')  # magic, capacity, channels, next row, rows used
+    MAGIC = b'C6SR'
+
+    def __init__(self, names, capacity=17280, path=None):
+        self.names = list(names)
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        channels = len(self.names)
+        size = self.HEADER.size + capacity * (8 + 4 * channels)
+        self.file = None
+        if path:
+            self.file = open(path, 'a+b')
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell() != size:
+                self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+        else:
+            self.buffer = bytearray(size)
+        magic, stored_capacity, stored_channels, self.head, self.count = self.HEADER.unpack_from(self.buffer)
+        if (magic, stored_capacity, stored_channels) != (self.MAGIC, capacity, channels):
+            self.head = self.count = 0
+        view = memoryview(self.buffer)
+        self.times = view[self.HEADER.size:self.HEADER.size + capacity * 8].cast('d')
+        self.values = view[self.HEADER.size + capacity * 8:].cast('f')
+
+    def append(self, timestamp, values):
+        channels = len(self.names)
+        with self.lock:
+            self.times[self.head] = timestamp
+            self.values[self.head * channels:(self.head + 1) * channels] = \
+                memoryview(struct.pack('%df' % channels, *values)).cast('f')
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.HEADER.pack_into(self.buffer, 0, self.MAGIC, self.capacity, channels, self.head, self.count)
+
+    def rows(self, since=0.0):
+        # [(timestamp, (values...))] newer than since, oldest first
+        channels = len(self.names)
+        rows = []
+        with self.lock:
+            for i in range(self.count):
+                row = (self.head - self.count + i) % self.capacity
+                if self.times[row] > since:
+                    rows.append((self.times[row], tuple(self.values[row * channels:(row + 1) * channels])))
+        return rows
+
+    def aggregate(self, since=0.0):
+        # {name: (min, max, avg)} over the samples newer than since
+        rows = self.rows(since)
+        if not rows:
+            return {}
+        result = {}
+        for index, name in enumerate(self.names):
+            column = [values[index] for timestamp, values in rows]
+            result[name] = (min(column), max(column), sum(column) / len(column))
+        return result
+
+    def export(self, path, since=0.0):
+        with open(path, 'w') as f:
+            f.write('time,' + ','.join(self.names) + '\n')
+            for timestamp, values in self.rows(since):
+                f.write(datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='seconds') + ',' +
+                        ','.join('%.1f' % value for value in values) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.buffer.flush()
+            self.times.release()
+            self.values.release()
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+
+class FrameCapture:
+    # Append-only log of raw register blocks. Each record is a little endian (timestamp, start, count)
+    # header followed by count registers, all blocks of one poll share the timestamp.
+
+    MAGIC = b'C6FR'
+    RECORD = struct.Struct('<dHH')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+
+    def write(self, timestamp, start, registers):
+        record = self.RECORD.pack(timestamp, start, len(registers)) + struct.pack('<%dH' % len(registers), *registers)
+        with self.lock:
+            self.file.write(record)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_frames(path):
+    # Yields (timestamp, start, registers) of a FrameCapture log
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != FrameCapture.MAGIC:
+        raise ValueError(path + ' is not a frame capture')
+    view = memoryview(data)
+    position = 4
+    while position + FrameCapture.RECORD.size <= len(data):
+        timestamp, start, count = FrameCapture.RECORD.unpack_from(view, position)
+        position += FrameCapture.RECORD.size
+        if position + count * 2 > len(data):
+            break
+        yield timestamp, start, struct.unpack_from('<%dH' % count, view, position)
+        position += count * 2
+
+
+class ReplaySource:
+    # Stands in for a Poller and serves a FrameCapture log instead of a controller. Every snapshot
+    # decodes the blocks of the next captured poll, so the log plays back as fast as it is consumed.
+
+    def __init__(self, path, plan):
+        self.path = path
+        self.plan = plan
+        self.session = self
+        self.ring = None
+        self.capture = None
+        self.online = True
+        self.values = {}
+        self.version = 0
+        self.frames = 0
+        self.done = False
+        self.pending = None
+        self.iterator = read_frames(path)
+
+    def __str__(self):
+        return 'replay:' + self.path
+
+    def snapshot(self):
+        self.pending, frames = self.next_poll()
+        changed = False
+        for timestamp, start, registers in frames:
+            decoded, block_changed = self.plan.decode(start, registers)
+            self.values.update(decoded)
+            changed = changed or block_changed
+        self.frames += len(frames)
+        if changed:
+            self.version += 1
+        return dict(self.values), self.version, self.online
+
+    def next_poll(self):
+        frames = [self.pending] if self.pending else []
+        for frame in self.iterator:
+            if frames and frame[0] != frames[0][0]:
+                return frame, frames
+            frames.append(frame)
+        self.done = True
+        return None, frames
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, address, value):
+        pass
+
+
+class Poller(threading.Thread):
+    # Background thread reading the groups the scheduler reports as due. The latest decoded values are
+    # kept under a lock, so the plugin thread only copies them and never waits on the network.
+
+    def __init__(self, session, plan, intervals=POLL_INTERVALS, clock=None, debounce=0.5, log=None):
+        threading.Thread.__init__(self, name='Poller ' + str(session), daemon=True)
+        self.session = session
+        self.plan = plan
+        # The clock group is read when ClockSync asks for it
+        self.scheduler = Scheduler([group for group in plan.groups if group != 'clock'], intervals)
+        self.commands = CommandQueue(debounce)
+        self.clock = clock
+        self.ring = None
+        self.capture = None
+        self.log = log or _no_log
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.values = {}
+        self.version = 0
+        self.online = True
+        self.reads = 0
+        self.writes = 0
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            retry = 0.01
+            try:
+                self.flush()
+                self.sync_clock()
+                self.poll()
+            except Exception as e:
+                self.log('Polling ' + str(self.session) + ' failed: ' + repr(e))
+                # Back off like a failed read instead of retrying at once, the error is likely to repeat
+                now = time.monotonic()
+                with self.lock:
+                    for group in self.scheduler.due(now):
+                        self.scheduler.failed(group, now)
+                    retry = min(low for low, high in self.scheduler.intervals.values())
+            with self.lock:
+                next_time = self.scheduler.next_time()
+            next_write = self.commands.next_time()
+            if next_write is not None:
+                next_time = min(next_time, next_write)
+            if self.clock is not None:
+                next_time = min(next_time, self.clock.next_time(time.monotonic(), datetime.datetime.now()))
+            self.wakeup.wait(max(next_time - time.monotonic(), retry))
+            self.wakeup.clear()
+
+    def poll(self):
+        with self.lock:
+            groups = self.scheduler.due(time.monotonic())
+        if self.clock is not None and self.clock.check_due(time.monotonic()):
+            groups.append('clock')
+        if not groups:
+            return
+        start = time.perf_counter()
+        values, updated = self.plan.read(self.session, groups, self.capture)
+        self.reads += len(self.plan.blocks_for(groups))
+        if self.session.metrics is not None:
+            self.session.metrics.observe('poll', time.perf_counter() - start)
+        # Keep values of queued writes out of the snapshot, they would undo the optimistic device update
+        pending = self.commands.addresses()
+        for point in self.plan.points:
+            if point.address in pending:
+                values.pop(point.name, None)
+
+        now = time.monotonic()
+        with self.lock:
+            # Groups read along inside another group's block are rescheduled as well
+            for group in self.scheduler.intervals:
+                names = [p.name for p in self.plan.points if p.group == group]
+                if all(name in values for name in names):
+                    changed = any(self.values.get(name) != values[name] for name in names)
+                    self.scheduler.observe(group, changed, now)
+                elif group in groups:
+                    self.scheduler.failed(group, now)
+            # Identical blocks leave the version alone, so the heartbeat skips the device updates
+            if updated:
+                self.values.update(values)
+                self.version += 1
+            if self.ring is not None and all(name in values for name in self.ring.names):
+                self.ring.append(time.time(), [values[name] for name in self.ring.names])
+            if self.online == self.session.breaker.is_open():
+                self.online = not self.online
+                self.version += 1
+            self.changed.notify_all()
+
+        if 'clock' in groups and all(name in values for name in ClockSync.NAMES):
+            offset = self.clock.observe(values, datetime.datetime.now(), now)
+            if offset:
+                self.session.log('Clock of ' + str(self.session) + ' is off by ' + str(offset) + ' s.')
+
+    def sync_clock(self):
+        if self.clock is None:
+            return
+        now = time.monotonic()
+        registers = self.clock.correction(now, datetime.datetime.now())
+        if registers is None:
+            return
+        result = self.session.write_registers(28, registers)
+        self.writes += 1
+        if result.isError():
+            self.log('Setting clock of ' + str(self.session) + ' failed: ' + str(result))
+            if self.clock.failed(now):
+                self.log('Clock of ' + str(self.session) + ' not corrected, retrying after the next check.')
+        else:
+            self.clock.synced(now)
+
+    def write(self, address, value):
+        self.commands.put(address, value)
+        self.wakeup.set()
+
+    def flush(self):
+        runs = self.commands.ready(time.monotonic())
+        if not runs:
+            return
+        results = self.session.execute_all([('write_register', (start, values[0])) if len(values) == 1 else
+                                            ('write_registers', (start, values)) for start, values in runs])
+        self.writes += len(runs)
+        written = []
+        for (start, values), result in zip(runs, results):
+            if result.isError():
+                self.log('Writing ' + str(values) + ' to ' + str(self.session) + ' register ' + str(start) +
+                         ' failed: ' + str(result))
+            else:
+                written.append((start, values))
+        self.verify(written)
+        for start, values in runs:
+            self.trigger(start)
+
+    def verify(self, runs):
+        # Read the written registers back and publish what the controller actually holds
+        results = self.session.execute_all([('read_holding_registers', (start, len(values)))
+                                            for start, values in runs])
+        self.reads += len(runs)
+        for (start, values), result in zip(runs, results):
+            if result.isError():
+                continue
+            if list(result.registers) != list(values):
+                self.log('Write of ' + str(values) + ' to ' + str(self.session) + ' register ' + str(start) +
+                         ' not confirmed, read back ' + str(result.registers))
+            # Compared with the snapshot, the decoder only knows the previous read-back of these registers
+            decoded = self.plan.decode(start, result.registers)[0]
+            with self.lock:
+                if any(self.values.get(name) != value for name, value in decoded.items()):
+                    self.values.update(decoded)
+                    self.version += 1
+                    self.changed.notify_all()
+
+    def trigger(self, address):
+        # Registers outside the map (kitchen and fireplace timers) switch the mode, so refresh the status
+        groups = self.plan.groups_at(address) or ['status']
+        with self.lock:
+            self.scheduler.trigger(groups, time.monotonic())
+        self.wakeup.set()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values), self.version, self.online
+
+    def wait(self, version, timeout=None):
+        # Snapshot as soon as it is newer than version, or after timeout
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return dict(self.values), self.version, self.online
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+# Default port of bridge.py, also used by the plugin for bridge addresses without a port
+BRIDGE_PORT = 5021
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    # Restartable right away and not keeping the process alive, without touching the stdlib class
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class BridgeServer:
+    # Shares one poller with any number of local readers over TCP. Every client receives the current
+    # snapshot on connect and each newer one as a JSON line
+    #   {"type": "snapshot", "controller": ..., "version": ..., "online": ..., "values": {...}}
+    # and may send {"type": "write", "address": ..., "value": ...} lines for the WRITABLE registers,
+    # which go through the poller's command queue, so the controller only ever sees one Modbus client.
+    # Each client has its own sender that skips to the newest snapshot, a client not taking a snapshot
+    # within send_timeout is dropped.
+
+    WRITABLE = (0, 2, 3, 4, 10, 5130, 5137)  # on/off, ECO, auto, mode, temperature control, kitchen, fireplace
+    MAX_LINE = 4096
+
+    def __init__(self, poller, host='127.0.0.1', port=BRIDGE_PORT, send_timeout=5.0, log=None):
+        self.poller = poller
+        self.send_timeout = send_timeout
+        self.log = log or _no_log
+        self.lock = threading.Lock()
+        self.clients = []
+        self.stopping = threading.Event()
+
+        bridge = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                bridge.serve(self.request)
+
+        self.server = ThreadingTCPServer((host, port), Handler)
+        self.threads = []
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        for target in (self.server.serve_forever, self.broadcast):
+            thread = threading.Thread(target=target, name='Bridge ' + str(self.poller.session), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+
+    def message(self, snapshot):
+        values, version, online = snapshot
+        return (json.dumps({'type': 'snapshot', 'controller': str(self.poller.session), 'version': version,
+                            'online': online, 'values': values}) + '\n').encode()
+
+    def serve(self, connection):
+        # The timeout bounds the sends, an idle reader just keeps waiting for commands
+        connection.settimeout(self.send_timeout)
+        name = str(connection.getpeername())
+        client = _BridgeSender(connection, name, self.log)
+        client.push(self.message(self.poller.snapshot()))
+        with self.lock:
+            self.clients.append(client)
+        threading.Thread(target=client.run, name='Bridge client ' + name, daemon=True).start()
+        self.log('Bridge client ' + name + ' connected.')
+        buffer = b''
+        try:
+            while not client.closed:
+                try:
+                    chunk = connection.recv(self.MAX_LINE)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    break
+                buffer += chunk
+                lines = buffer.split(b'\n')
+                buffer = lines.pop()
+                if len(buffer) > self.MAX_LINE:
+                    self.log('Bridge client ' + name + ' sent an overlong line, dropped.')
+                    break
+                for line in lines:
+                    self.command(line)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.clients.remove(client)
+            client.close()
+
+    def command(self, line):
+        try:
+            command = json.loads(line)
+            if command.get('type') != 'write':
+                raise ValueError('unknown type')
+            address, value = int(command['address']), int(command['value'])
+            if address not in self.WRITABLE:
+                raise ValueError('register ' + str(address) + ' is not writable')
+            if not 0 <= value <= 0xFFFF:
+                raise ValueError('value out of range')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.log('Invalid bridge command ' + repr(line) + ': ' + str(e))
+            return
+        self.poller.write(address, value)
+
+    def broadcast(self):
+        version = None
+        while not self.stopping.is_set():
+            snapshot = self.poller.wait(version, 1.0)
+            if snapshot[1] == version:
+                continue
+            version = snapshot[1]
+            message = self.message(snapshot)
+            with self.lock:
+                for client in self.clients:
+                    client.push(message)
+
+
+class _BridgeSender:
+    # Newest pending message of one bridge client and the loop sending it
+
+    def __init__(self, connection, name, log):
+        self.connection = connection
+        self.name = name
+        self.log = log
+        self.ready = threading.Condition()
+        self.message = None
+        self.closed = False
+
+    def push(self, message):
+        with self.ready:
+            self.message = message
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        _shutdown(self.connection)
+
+    def run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.message is not None or self.closed)
+                if self.closed:
+                    return
+                message, self.message = self.message, None
+            try:
+                self.connection.sendall(message)
+            except OSError as e:
+                self.log('Bridge client ' + self.name + ' dropped: ' + str(e))
+                self.close()
+                return
+
+
+class BridgeClient(threading.Thread):
+    # Stands in for a Poller and follows the snapshots of a BridgeServer, writes are forwarded to it.
+    # The controller counts as offline while the bridge cannot be reached.
+
+    def __init__(self, host, port=BRIDGE_PORT, timeout=3, retry=5, log=None):
+        threading.Thread.__init__(self, name='Bridge client ' + str(host) + ':' + str(port), daemon=True)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retry = retry
+        self.log = log or _no_log
+        self.session = self
+        self.ring = None
+        self.capture = None
+        self.lock = threading.Lock()
+        self.values = {}
+        self.version = 0
+        self.online = True
+        self.connection = None
+        self.stopping = threading.Event()
+
+    def __str__(self):
+        return 'bridge:' + str(self.host) + ':' + str(self.port)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.follow()
+            except (OSError, ValueError) as e:
+                if not self.stopping.is_set():
+                    self.log('Bridge ' + str(self) + ' failed: ' + str(e))
+            with self.lock:
+                self.connection = None
+                if self.online:
+                    self.online = False
+                    self.version += 1
+            self.stopping.wait(self.retry)
+
+    def follow(self):
+        connection = socket.create_connection((self.host, self.port), self.timeout)
+        connection.settimeout(None)
+        with self.lock:
+            self.connection = connection
+        for line in connection.makefile('r'):
+            message = json.loads(line)
+            if message.get('type') != 'snapshot':
+                continue
+            with self.lock:
+                self.values = message['values']
+                self.online = message['online']
+                self.version += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values), self.version, self.online
+
+    def write(self, address, value):
+        with self.lock:
+            connection = self.connection
+        if connection is None:
+            self.log('Bridge ' + str(self) + ' not connected, write to register ' + str(address) + ' dropped.')
+            return
+        try:
+            connection.sendall((json.dumps({'type': 'write', 'address': address, 'value': value}) + '\n').encode())
+        except OSError as e:
+            self.log('Bridge ' + str(self) + ' write failed: ' + str(e))
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        with self.lock:
+            if self.connection is not None:
+                _shutdown(self.connection)
+        if self.is_alive():
+            self.join(timeout)
+
+    def close(self):
+        pass
+
+
+def _receive(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionException('Connection closed by the controller')
+        data += chunk
+    return data
+
+
+def _shutdown(connection):
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
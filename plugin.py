@@ -17,11 +17,16 @@
         </ul>
         <h3>Configuration</h3>
         Set correct IP address for your ventilation central.
-        If you do not know IP it is good guess that default will fit.
+        If you do not know IP it is good guess that default will fit.<br/>
+        Up to 4 controllers can be polled by one hardware entry, separate their addresses with commas
+        (<i>host</i> or <i>host:port</i>). Devices of the second controller start at unit 65, of the third at 129.<br/>
+        Options is an optional list of key=value pairs separated by semicolons, e.g. <i>timeout=3;idle_timeout=60</i>.<br/>
+        With the option <i>bridge=1</i> the addresses are bridge.py daemons, port 5021 unless given as <i>host:port</i>.
     </description>
     <params>
-        <param field="Address" label="IP Address" width="200px" required="true" default="127.0.0.1"/>
+        <param field="Address" label="IP Address(es)" width="200px" required="true" default="127.0.0.1"/>
         <param field="Port" label="Port" width="30px" required="true" default="502"/>
+        <param field="Mode1" label="Options" width="300px" default=""/>
         <param field="Mode5" label="SyncTime" width="75px">
             <options>
                 <option label="True" value="true"/>
@@ -38,12 +43,11 @@
 </plugin>
 """
 import Domoticz
-import ctypes
-import datetime
+import time
 
-from pymodbus.constants import Endian
-from pymodbus.client.sync import ModbusTcpClient
-from pymodbus.payload import BinaryPayloadDecoder
+from komfovent import CircuitBreaker, ClockSync, Metrics, ModbusSession, Poller, ReadPlan, REGISTER_MAP, SECTIONS
+from komfovent import BRIDGE_PORT, BridgeClient, FrameCapture, ReplaySource, SampleRing
+from komfovent import find_sections, load_capabilities, parse_intervals, parse_sections, plan_points, save_capabilities
 
 
 class BasePlugin:
@@ -79,11 +83,152 @@ class BasePlugin:
         'TempControlType': 50,
         'OnOff': 51,
         'Kitchen': 52,
-        'Fireplace': 53
+        'Fireplace': 53,
+
+        'ModbusLatency': 60,
+        'HeartbeatDuration': 61,
+        'ModbusErrorRate': 62,
+        'ExportHistory': 63
+        }
+
+    # Units of further controllers are shifted by a multiple of UNIT_STRIDE, Domoticz allows units up to 255
+    UNIT_STRIDE = 64
+    MAX_CONTROLLERS = 4
+
+    UNIT_NAMES = dict((unit, name) for name, unit in UNITS.items())
+
+    # Publish deadbands of measured values, absolute or relative ('5%') to the last published value.
+    # Devices of kWh type have one band per field (power/total), the lifetime totals would hardly ever
+    # leave a relative band, so any change of them is published.
+    DEADBANDS = {
+        'Temp': 0.1,
+        'Hum': 1,
+        'OutdoorTemp': 0.1,
+        'SupplyTemp': 0.1,
+        'ExtractTemp': 0.1,
+        'WaterTemp': 0.1,
+        'TotalEnergyConsumtion': '5%/0',
+        'TotalHeaterConsumtion': '5%/0',
+        'TotalEnergyRecovered': '5%/0',
+        'CurrentExchangeEfficiency': 1,
+        'CurrentEnergySaving': 1,
+        'SupplyFanIntensivity': 1,
+        'ExtractFanIntensivity': 1,
+        'HeatExchanger': 1,
+        'ElectricHeater': 1,
+        'WaterHeater': 1,
+        'WaterCooler': 1,
+        'DXUnit': 1,
+        'FiltersImupurity': 1,
+        }
+
+    # Seconds between updates of the metrics devices and file
+    METRICS_PERIOD = 60
+    METRICS_NAMES = ('ModbusLatency', 'HeartbeatDuration', 'ModbusErrorRate')
+    METRICS_UNITS = (UNITS['ModbusLatency'], UNITS['HeartbeatDuration'], UNITS['ModbusErrorRate'])
+    # Units not fed by the controller, an outage leaves them alone
+    LOCAL_UNITS = METRICS_UNITS + (UNITS['ExportHistory'],)
+
+    MODE_OPTIONS = {"LevelActions": "||||||||||",
+                    "LevelNames": "Standby|Away|Normal|Intensive|Boost|Kitchen|Fireplace|Ovveride|Holiday|AirQuality|Off",
+                    "LevelOffHidden": "false",
+                    "SelectorStyle": "1"}
+    TEMP_CONTROL_OPTIONS = {"LevelActions": "||||",
+                            "LevelNames": "Off|Supply|Extract|Room|Balance",
+                            "LevelOffHidden": "true",
+                            "SelectorStyle": "1"}
+
+    # UNITS entry, device name and Domoticz.Device arguments of every device the plugin creates
+    DEVICES = [
+        ('OnOff', "OnOff", {'TypeName': "Switch", 'Image': 9}),
+        ('ECO', "ECO", {'TypeName': "Switch", 'Image': 9}),
+        ('Auto', "Auto", {'TypeName': "Switch", 'Image': 9}),
+        ('Temp', "Panel1 Temperature", {'TypeName': "Temperature"}),
+        ('Hum', "Panel1 Humidity", {'TypeName': "Humidity"}),
+        ('Mode', "Mode", {'TypeName': "Selector Switch", 'Image': 7, 'Options': MODE_OPTIONS}),
+
+        ('OutdoorTemp', "Outside Temperature", {'TypeName': "Temperature"}),
+        ('SupplyTemp', "Air Blowed In Temperature", {'TypeName': "Temperature"}),
+        ('ExtractTemp', "Air Blowed Out Temperature", {'TypeName': "Temperature"}),
+        ('WaterTemp', "Water Temperature", {'TypeName': "Temperature"}),
+
+        ('SupplyFanIntensivity', "Supply Fan Intensivity", {'TypeName': "Percentage"}),
+        ('ExtractFanIntensivity', "Extract Fan Intensivity", {'TypeName': "Percentage"}),
+        ('HeatExchanger', "Heat Exchanger", {'TypeName': "Percentage"}),
+        ('ElectricHeater', "Electric Heater", {'TypeName': "Percentage"}),
+        ('WaterHeater', "Water Heater", {'TypeName': "Percentage"}),
+        ('WaterCooler', "Water Cooler", {'TypeName': "Percentage"}),
+        ('DXUnit', "DX Unit", {'TypeName': "Percentage"}),
+        ('FiltersImupurity', "Filters Imupurity", {'TypeName': "Percentage"}),
+
+        ('CurrentEnergySaving', "Current Energy Saving", {'TypeName': "Percentage"}),
+        ('CurrentExchangeEfficiency', "Current Exchange Efficiency", {'TypeName': "Percentage"}),
+        ('TotalEnergyConsumtion', "Total Power Consumption", {'TypeName': "kWh"}),
+        ('TotalHeaterConsumtion', "Total Heater Consumption", {'TypeName': "kWh"}),
+        ('TotalEnergyRecovered', "Total Energy Recovered", {'TypeName': "kWh"}),
+
+        ('TempControlType', "TempControlType", {'TypeName': "Selector Switch", 'Image': 7,
+                                                'Options': TEMP_CONTROL_OPTIONS}),
+        ('Kitchen', "Kitchen", {'TypeName': "Dimmer"}),
+        ('Fireplace', "Fireplace", {'TypeName': "Dimmer"}),
+
+        ('ModbusLatency', "Modbus Read Latency p90", {'TypeName': "Custom", 'Options': {"Custom": "1;ms"}}),
+        ('HeartbeatDuration', "Heartbeat Duration p90", {'TypeName': "Custom", 'Options': {"Custom": "1;ms"}}),
+        ('ModbusErrorRate', "Modbus Error Rate", {'TypeName': "Percentage"}),
+        ('ExportHistory', "Export History", {'TypeName': "Switch", 'Switchtype': 9}),
+        ]
+
+    # Monitoring values kept in the sample ring when sample_interval is set
+    SAMPLE_NAMES = ('SupplyTemp', 'ExtractTemp', 'OutdoorTemp', 'WaterTemp', 'SupplyFanIntensivity',
+                    'ExtractFanIntensivity', 'HeatExchanger', 'ElectricHeater', 'WaterHeater', 'WaterCooler', 'DXUnit')
+
+    # Devices showing the decoded value as nValue too
+    NVALUE_UNITS = ('OnOff', 'ECO', 'Auto', 'Mode', 'TempControlType', 'Hum')
+    # kWh devices and the point holding their current power
+    ENERGY_UNITS = {
+        'TotalEnergyConsumtion': 'CurrentPowerConsumption',
+        'TotalHeaterConsumtion': 'CurrentHeaterPower',
+        'TotalEnergyRecovered': 'CurrentHeatRecovery',
+        }
+
+    DEFAULT_OPTIONS = {
+        'timeout': 3.0,        # Modbus socket timeout in seconds
+        'idle_timeout': 60.0,  # reconnect before use when the session was idle longer than this
+        'pipelining': 1,       # 1 sends the reads of a poll back to back, 0 waits for every answer
+        'max_gap': 8,          # unused registers a block read may span to merge neighbouring points
+        'max_block': 125,      # registers per block read
+        'intervals': '',       # poll interval overrides, e.g. status:10-50,energy:60-600
+        'sections': '',        # installed optional sections (water_heater,water_cooler,dx_unit or all), probed when empty
+        'reprobe': 0,          # 1 probes the sections again instead of using the capabilities file
+        'debounce': 0.5,       # seconds a register must stay untouched before a queued write is sent
+        'deadbands': '',       # deadband overrides, e.g. OutdoorTemp:0.3,TotalEnergyConsumtion:2%/1
+        'min_interval': 30.0,  # seconds between two publishes of a measured value
+        'refresh_interval': 900.0,  # a measured value is republished at least this often
+        'breaker_threshold': 3,  # consecutive failed transactions taking a controller offline
+        'breaker_backoff': 5.0,  # seconds before the first reconnect attempt, doubled on every failure
+        'breaker_max_backoff': 300.0,
+        'clock_check': 21600.0,  # seconds between reads of the controller clock when SyncTime is on
+        'sample_interval': 0.0,  # seconds between monitoring samples kept in memory, 0 disables sampling
+        'sample_capacity': 17280,  # samples kept per controller
+        'sample_file': '',     # memory mapped file keeping the samples across restarts
+        'capture': '',         # file the raw register blocks of every poll are appended to
+        'replay': '',          # capture file to play back instead of polling the controllers
+        'bridge': 0,           # 1 reads the addresses as bridge.py daemons instead of controllers
+        'metrics': 0,          # 1 collects timings and error rates into metrics devices and a text file
+        'metrics_file': '',    # defaults to metrics_<hardware id>.txt in the plugin folder
         }
 
     def __init__(self):
         self.sync_time = False
+        self.options = dict(self.DEFAULT_OPTIONS)
+        self.pollers = []
+        self.versions = []
+        self.updated = []
+        self.deadbands = {}
+        self.published = {}
+        self.metrics = None
+        self.metrics_published = 0
+        self.sampled = []
         return
 
     def onStart(self):
@@ -97,95 +242,136 @@ class BasePlugin:
         else:
             Domoticz.Debugging(0)
 
-        self.client = ModbusTcpClient(Parameters['Address'], port=int(Parameters['Port']))
-
-        if self.UNITS['OnOff'] not in Devices:
-            Domoticz.Device(Name="OnOff", Unit=self.UNITS['OnOff'], TypeName="Switch", Image=9, Used=1).Create()
-        if self.UNITS['ECO'] not in Devices:
-            Domoticz.Device(Name="ECO", Unit=self.UNITS['ECO'], TypeName="Switch", Image=9, Used=1).Create()
-        if self.UNITS['Auto'] not in Devices:
-            Domoticz.Device(Name="Auto", Unit=self.UNITS['Auto'], TypeName="Switch", Image=9, Used=1).Create()
-        if self.UNITS['Temp'] not in Devices:
-            Domoticz.Device(Name="Panel1 Temperature", Unit=self.UNITS['Temp'], TypeName="Temperature", Used=1).Create()
-        if self.UNITS['Hum'] not in Devices:
-            Domoticz.Device(Name="Panel1 Humidity", Unit=self.UNITS['Hum'], TypeName="Humidity", Used=1).Create()
-        if self.UNITS['Mode'] not in Devices:
-            Options = {"LevelActions": "||||||||||",
-                       "LevelNames": "Standby|Away|Normal|Intensive|Boost|Kitchen|Fireplace|Ovveride|Holiday|AirQuality|Off",
-                       "LevelOffHidden": "false",
-                       "SelectorStyle": "1"}
-            Domoticz.Device(Name="Mode", Unit=self.UNITS['Mode'], TypeName="Selector Switch", Used=1, Image=7,
-                            Options=Options).Create()
-
-        if self.UNITS['OutdoorTemp'] not in Devices:
-            Domoticz.Device(Name="Outside Temperature", Unit=self.UNITS['OutdoorTemp'],
-                            TypeName="Temperature", Used=1).Create()
-        if self.UNITS['SupplyTemp'] not in Devices:
-            Domoticz.Device(Name="Air Blowed In Temperature", Unit=self.UNITS['SupplyTemp'],
-                            TypeName="Temperature", Used=1).Create()
-        if self.UNITS['ExtractTemp'] not in Devices:
-            Domoticz.Device(Name="Air Blowed Out Temperature", Unit=self.UNITS['ExtractTemp'],
-                            TypeName="Temperature", Used=1).Create()
-        if self.UNITS['WaterTemp'] not in Devices:
-            Domoticz.Device(Name="Water Temperature", Unit=self.UNITS['WaterTemp'],
-                            TypeName="Temperature", Used=1).Create()
-
-        if self.UNITS['SupplyFanIntensivity'] not in Devices:
-            Domoticz.Device(Name="Supply Fan Intensivity", Unit=self.UNITS['SupplyFanIntensivity'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['ExtractFanIntensivity'] not in Devices:
-            Domoticz.Device(Name="Extract Fan Intensivity", Unit=self.UNITS['ExtractFanIntensivity'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['HeatExchanger'] not in Devices:
-            Domoticz.Device(Name="Heat Exchanger", Unit=self.UNITS['HeatExchanger'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['ElectricHeater'] not in Devices:
-            Domoticz.Device(Name="Electric Heater", Unit=self.UNITS['ElectricHeater'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['WaterHeater'] not in Devices:
-            Domoticz.Device(Name="Water Heater", Unit=self.UNITS['WaterHeater'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['WaterCooler'] not in Devices:
-            Domoticz.Device(Name="Water Cooler", Unit=self.UNITS['WaterCooler'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['DXUnit'] not in Devices:
-            Domoticz.Device(Name="DX Unit", Unit=self.UNITS['DXUnit'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['FiltersImupurity'] not in Devices:
-            Domoticz.Device(Name="Filters Imupurity", Unit=self.UNITS['FiltersImupurity'],
-                            TypeName="Percentage", Used=1).Create()
-
-        if self.UNITS['CurrentEnergySaving'] not in Devices:
-            Domoticz.Device(Name="Current Energy Saving", Unit=self.UNITS['CurrentEnergySaving'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['CurrentExchangeEfficiency'] not in Devices:
-            Domoticz.Device(Name="Current Exchange Efficiency", Unit=self.UNITS['CurrentExchangeEfficiency'],
-                            TypeName="Percentage", Used=1).Create()
-        if self.UNITS['TotalEnergyConsumtion'] not in Devices:
-            Domoticz.Device(Name="Total Power Consumption", Unit=self.UNITS['TotalEnergyConsumtion'],
-                            TypeName="kWh", Used=1).Create()
-        if self.UNITS['TotalHeaterConsumtion'] not in Devices:
-            Domoticz.Device(Name="Total Heater Consumption", Unit=self.UNITS['TotalHeaterConsumtion'],
-                            TypeName="kWh", Used=1).Create()
-        if self.UNITS['TotalEnergyRecovered'] not in Devices:
-            Domoticz.Device(Name="Total Energy Recovered", Unit=self.UNITS['TotalEnergyRecovered'],
-                            TypeName="kWh", Used=1).Create()
-
-        if self.UNITS['TempControlType'] not in Devices:
-            Options = {"LevelActions": "||||",
-                       "LevelNames": "Off|Supply|Extract|Room|Balance",
-                       "LevelOffHidden": "true",
-                       "SelectorStyle": "1"}
-            Domoticz.Device(Name="TempControlType", Unit=self.UNITS['TempControlType'], TypeName="Selector Switch", Used=1, Image=7,
-                            Options=Options).Create()
-
-        if self.UNITS['Kitchen'] not in Devices:
-            Domoticz.Device(Name="Kitchen", Unit=self.UNITS['Kitchen'], TypeName="Dimmer", Used=1).Create()
-        if self.UNITS['Fireplace'] not in Devices:
-            Domoticz.Device(Name="Fireplace", Unit=self.UNITS['Fireplace'], TypeName="Dimmer", Used=1).Create()
+        self.options = ParseOptions(Parameters['Mode1'], self.DEFAULT_OPTIONS)
+        self.deadbands = ParseDeadbands(self.options['deadbands'], self.DEADBANDS)
+        if self.options['metrics']:
+            self.metrics = Metrics()
+            self.metrics_published = time.monotonic()
+            if not self.options['metrics_file']:
+                self.options['metrics_file'] = Parameters['HomeFolder'] + 'metrics_' + str(Parameters['HardwareID']) + '.txt'
+
+        try:
+            intervals = parse_intervals(self.options['intervals'])
+        except ValueError:
+            Domoticz.Error("Invalid intervals option '" + self.options['intervals'] + "' ignored.")
+            intervals = parse_intervals('')
+        ceiling = min(high for low, high in intervals.values())
+        if self.options['idle_timeout'] and ceiling >= self.options['idle_timeout']:
+            Domoticz.Error("All poll intervals may reach idle_timeout, the Modbus connection will be reopened on "
+                           "every poll.")
+
+        # Bridge addresses default to the bridge port, Port is the controllers' Modbus port
+        port = BRIDGE_PORT if self.options['bridge'] else int(Parameters['Port'])
+        endpoints = ParseEndpoints(Parameters['Address'], port)
+        if len(endpoints) > self.MAX_CONTROLLERS:
+            Domoticz.Error("Only " + str(self.MAX_CONTROLLERS) + " controllers are supported, ignoring the rest.")
+            endpoints = endpoints[:self.MAX_CONTROLLERS]
+
+        if self.options['replay']:
+            # Offline mode, the devices are fed from a capture log instead of a controller
+            plan = ReadPlan(plan_points(list(SECTIONS)), self.options['max_gap'],
+                            self.options['max_block'])
+            self.pollers.append(ReplaySource(self.options['replay'], plan))
+            self.versions.append(0)
+            self.updated.append(0.0)
+            self.sampled.append(time.time())
+            self.CreateDevices(0, "", [unit for unit in self.UNITS if unit not in self.METRICS_NAMES and
+                                       unit != 'ExportHistory'])
+            return
+
+        if self.options['bridge']:
+            # The daemons poll the controllers, the plugin only follows their snapshots
+            sections = parse_sections(self.options['sections']) or list(SECTIONS)
+            absent = set(p.unit for p in REGISTER_MAP if p.section is not None and p.section not in sections)
+            absent.add('ExportHistory')
+            for index, (host, port) in enumerate(endpoints):
+                poller = BridgeClient(host, port, timeout=self.options['timeout'], log=Domoticz.Error)
+                self.pollers.append(poller)
+                self.versions.append(0)
+                self.updated.append(0.0)
+                self.sampled.append(time.time())
+                units = [unit for unit in self.UNITS if unit not in absent and unit not in self.METRICS_NAMES]
+                prefix = (str(poller) + " ") if len(endpoints) > 1 else ""
+                self.CreateDevices(index * self.UNIT_STRIDE, prefix, units)
+                poller.start()
+            return
+
+        capabilities_file = Parameters['HomeFolder'] + 'capabilities_' + str(Parameters['HardwareID']) + '.json'
+        capabilities = load_capabilities(capabilities_file)
+        probed = False
+
+        # Every controller gets its own session and poller thread, so all units are read in parallel
+        for index, (host, port) in enumerate(endpoints):
+            breaker = CircuitBreaker(self.options['breaker_threshold'], self.options['breaker_backoff'],
+                                     self.options['breaker_max_backoff'])
+            session = ModbusSession(host, port=port, timeout=self.options['timeout'],
+                                    idle_timeout=self.options['idle_timeout'], log=Domoticz.Debug,
+                                    metrics=self.metrics, breaker=breaker,
+                                    pipelining=bool(self.options['pipelining']))
+
+            # Optional sections are probed once per controller, the result is kept in capabilities_file
+            sections, found = find_sections(session, self.options['sections'], capabilities, self.options['reprobe'],
+                                            log=Domoticz.Log, error=Domoticz.Error)
+            probed = probed or found
+
+            points = plan_points(sections, self.sync_time)
+            plan = ReadPlan(points, self.options['max_gap'], self.options['max_block'])
+            Domoticz.Debug("Read plan of " + str(session) + ": " + str(plan))
+            clock = ClockSync(self.options['clock_check']) if self.sync_time else None
+            poller_intervals = intervals
+            if self.options['sample_interval'] > 0:
+                poller_intervals = dict(intervals)
+                poller_intervals['monitoring'] = (self.options['sample_interval'], self.options['sample_interval'])
+            poller = Poller(session, plan, poller_intervals, clock, self.options['debounce'], log=Domoticz.Error)
+            if self.options['sample_interval'] > 0:
+                names = [p.name for p in points if p.name in self.SAMPLE_NAMES]
+                path = self.options['sample_file']
+                if path and index:
+                    path += '.' + str(index)
+                poller.ring = SampleRing(names, self.options['sample_capacity'], path)
+            if self.options['capture']:
+                path = self.options['capture'] + ('.' + str(index) if index else '')
+                poller.capture = FrameCapture(path)
+            self.pollers.append(poller)
+            self.versions.append(0)
+            self.updated.append(0.0)
+            self.sampled.append(time.time())
+
+            absent = set(p.unit for p in REGISTER_MAP if p.section is not None and p.section not in sections)
+            if poller.ring is None:
+                absent.add('ExportHistory')
+            units = [unit for unit in self.UNITS if unit not in absent and unit not in self.METRICS_NAMES]
+            prefix = (str(session) + " ") if len(endpoints) > 1 else ""
+            self.CreateDevices(index * self.UNIT_STRIDE, prefix, units)
+
+        if probed:
+            try:
+                save_capabilities(capabilities_file, capabilities)
+            except IOError as e:
+                Domoticz.Error("Unable to write " + capabilities_file + ": " + str(e))
+
+        for poller in self.pollers:
+            poller.start()
+
+        if self.metrics is not None:
+            self.CreateDevices(0, "", self.METRICS_NAMES)
+
+    def CreateDevices(self, offset, prefix, units):
+        for unit, name, kwargs in self.DEVICES:
+            if unit in units and offset + self.UNITS[unit] not in Devices:
+                Domoticz.Device(Name=prefix + name, Unit=offset + self.UNITS[unit], Used=1, **kwargs).Create()
 
     def onStop(self):
         Domoticz.Log("onStop called")
+        # Domoticz requires all plugin threads to be finished before onStop returns
+        for poller in self.pollers:
+            poller.stop()
+        for poller in self.pollers:
+            poller.session.close()
+            if poller.ring is not None:
+                poller.ring.close()
+            if poller.capture is not None:
+                poller.capture.close()
 
     def onConnect(self, Connection, Status, Description):
         Domoticz.Log("onConnect called")
@@ -196,34 +382,47 @@ class BasePlugin:
     def onCommand(self, Unit, Command, Level, Hue):
         Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " +
                      str(Level) + str(Hue))
-        self.client.connect()
+        index = Unit // self.UNIT_STRIDE
+        if index >= len(self.pollers):
+            return
+        poller = self.pollers[index]
+        offset = index * self.UNIT_STRIDE
+        Unit -= offset
+
+        if Unit == self.UNITS['ExportHistory'] and poller.ring is not None:
+            path = Parameters['HomeFolder'] + 'history_' + str(Parameters['HardwareID']) + '_' + str(index) + '.csv'
+            try:
+                poller.ring.export(path)
+                Domoticz.Log("History of " + str(poller.session) + " exported to " + path)
+            except IOError as e:
+                Domoticz.Error("Unable to export history: " + str(e))
+            return
 
         if Command == 'Set Level':
             if Unit == self.UNITS['Mode']:
                 if Level in self.available_mode_levels:
-                    self.client.write_register(4, value=int(Level/10))
-                    UpdateDevice(Unit, Level, Level, 0)
+                    self.WriteRegister(poller, 4, value=int(Level/10))
+                    self.PublishDevice(offset + Unit, Level, Level, 0, Force=True)
                     Domoticz.Log("Air flow mode changed.")
                 else:
                     Domoticz.Log("Impossible to choose this mode.")
 
             elif Unit == self.UNITS['TempControlType']:
                 if Level in self.available_mode_levels:
-                    self.client.write_register(10, value=int((Level-10)/10))
-                    UpdateDevice(Unit, Level, Level, 0)
+                    self.WriteRegister(poller, 10, value=int((Level-10)/10))
+                    self.PublishDevice(offset + Unit, Level, Level, 0, Force=True)
                     Domoticz.Log("Temperature Flow Control mode changed." +str(int((Level-10)/10)))
                 else:
                     Domoticz.Log("Impossible to choose this Temperature Flow Control mode.")
 
             elif Unit == self.UNITS['Kitchen']:
-                self.client.write_register(5130, Level)
-                UpdateDevice(Unit, Level, Level, 0)
+                self.WriteRegister(poller, 5130, Level)
+                self.PublishDevice(offset + Unit, Level, Level, 0, Force=True)
 
             elif Unit == self.UNITS['Fireplace']:
-                self.client.write_register(5137, Level)
-                UpdateDevice(Unit, Level, Level, 0)
+                self.WriteRegister(poller, 5137, Level)
+                self.PublishDevice(offset + Unit, Level, Level, 0, Force=True)
 
-            self.client.close()
             return
 
         if Command == 'Off':
@@ -238,9 +437,12 @@ class BasePlugin:
         elif Unit == self.UNITS['Auto']:
             rAddr = 3
 
-        self.client.write_register(rAddr, value=nVal)
-        UpdateDevice(Unit, nVal, Command, 0)
-        self.client.close()
+        self.WriteRegister(poller, rAddr, value=nVal)
+        self.PublishDevice(offset + Unit, nVal, Command, 0, Force=True)
+
+    def WriteRegister(self, poller, address, value):
+        # Queued for the poller thread, the device is updated optimistically by the caller
+        poller.write(address, value)
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
         Domoticz.Log("Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
@@ -249,127 +451,110 @@ class BasePlugin:
         Domoticz.Log("onDisconnect called")
 
     def onHeartbeat(self):
-        self.client.connect()
-
-        result = self.client.read_holding_registers(0, 11)
-        if not result.isError():
-            on_off = int(result.registers[0])
-            eco = int(result.registers[2])
-            auto = int(result.registers[3])
-            mode = int(result.registers[4]) * 10
-            temp_control = int(result.registers[10]) * 10 + 10
-
-            UpdateDevice(self.UNITS['OnOff'], on_off, str(on_off), 0)
-            UpdateDevice(self.UNITS['ECO'], eco, str(eco), 0)
-            UpdateDevice(self.UNITS['Auto'], auto,  str(auto), 0)
-            UpdateDevice(self.UNITS['Mode'], mode, str(mode), 0)
-            if mode == 50:  # Kitchen
-                UpdateDevice(self.UNITS['Kitchen'], 5, str(5), 0)
-            elif mode == 60:  # Fireplace
-                UpdateDevice(self.UNITS['Fireplace'], 5, str(5), 0)
-            else:
-                UpdateDevice(self.UNITS['Kitchen'], 0, str(0), 0)
-                UpdateDevice(self.UNITS['Fireplace'], 0, str(0), 0)
-
-            UpdateDevice(self.UNITS['TempControlType'], temp_control, str(temp_control), 0)
-
-        if self.sync_time:
-            result = self.client.read_holding_registers(28, 3)
-            if not result.isError():
-                time = int(result.registers[0])
-                hour, min = time >> 8, time & 0x00FF
-                year = int(result.registers[1])
-                date = int(result.registers[2])
-                month, day = date >> 8, date & 0x00FF
-
-                d1 = datetime.datetime.now()
-                if d1.hour != hour or d1.minute != min:
-                    time = d1.hour << 8 | d1.minute & 0x00FF
-                    self.client.write_register(28, value=time)
-
-                if d1.year != year:
-                    self.client.write_register(29, value=year)
-
-                if d1.month != month or d1.day != day:
-                    date = d1.month << 8 | d1.day & 0x00FF
-                    self.client.write_register(30, value=date)
-
-        registersStartingOffset = 20
-        MonitoringDataResult = self.client.read_holding_registers(900, 47)
-
-        if not MonitoringDataResult.isError():
-            SupplyTemp  = ConvertToFloat(MonitoringDataResult, 1)
-            ExtractTemp = ConvertToFloat(MonitoringDataResult, 2)
-            OutdoorTemp = ConvertToFloat(MonitoringDataResult, 3)
-            WaterTemp   = ConvertToFloat(MonitoringDataResult, 4)
-
-            UpdateDevice(self.UNITS['OutdoorTemp'], 0, str(OutdoorTemp), 0)
-            UpdateDevice(self.UNITS['SupplyTemp'], 0, str(SupplyTemp), 0)
-            UpdateDevice(self.UNITS['ExtractTemp'], 0, str(ExtractTemp), 0)
-            UpdateDevice(self.UNITS['WaterTemp'], 0, str(WaterTemp), 0)
-
-            SupplyFanIntens     = ConvertToFloat(MonitoringDataResult, 9)
-            ExtractFanIntens    = ConvertToFloat(MonitoringDataResult, 10)
-            HeatExchanger       = ConvertToFloat(MonitoringDataResult, 11)
-            ElectricHeater      = ConvertToFloat(MonitoringDataResult, 12)
-            WaterHeater         = ConvertToFloat(MonitoringDataResult, 13)
-            WaterCooling        = ConvertToFloat(MonitoringDataResult, 14)
-            DXUnit              = ConvertToFloat(MonitoringDataResult, 15)
-            FiltersImupurity    = float(MonitoringDataResult.registers[16])
-
-            UpdateDevice(self.UNITS['SupplyFanIntensivity'], 0, str(SupplyFanIntens), 0)
-            UpdateDevice(self.UNITS['ExtractFanIntensivity'], 0, str(ExtractFanIntens), 0)
-            UpdateDevice(self.UNITS['HeatExchanger'], 0, str(HeatExchanger), 0)
-            UpdateDevice(self.UNITS['ElectricHeater'], 0, str(ElectricHeater), 0)
-            UpdateDevice(self.UNITS['WaterHeater'], 0, str(WaterHeater), 0)
-            UpdateDevice(self.UNITS['WaterCooler'], 0, str(WaterCooling), 0)
-            UpdateDevice(self.UNITS['DXUnit'], 0, str(DXUnit), 0)
-            UpdateDevice(self.UNITS['FiltersImupurity'], 0, str(FiltersImupurity), 0)
-
-            CurrentPowerConsumption = int(MonitoringDataResult.registers[0+registersStartingOffset])
-            CurrentHeaterPower = int(MonitoringDataResult.registers[1+registersStartingOffset])
-            CurrentHeatRecovery = int(MonitoringDataResult.registers[2+registersStartingOffset])
-            CurrentExchangeEfficiency = int(MonitoringDataResult.registers[3+registersStartingOffset])
-            CurrentEnergySaving = int(MonitoringDataResult.registers[4+registersStartingOffset])
-
-            decoder = BinaryPayloadDecoder.fromRegisters(MonitoringDataResult.registers,
-                                               byteorder=Endian.Big)
-
-            decoder.skip_bytes(6+17*2+5*4) # 6 * char + 17 * short + 5 * int
-            TotalEnergyConsumtion = decoder.decode_32bit_uint()  # reg[11-12] from byte[21]
-            UpdateDevice(self.UNITS['TotalEnergyConsumtion'], 0, str(CurrentPowerConsumption)+';'+str(TotalEnergyConsumtion), 0)
-
-            decoder.skip_bytes(8)
-            TotalHeaterConsumtion = decoder.decode_32bit_uint()  # reg[17-18] from byte[32]
-            UpdateDevice(self.UNITS['TotalHeaterConsumtion'], 0, str(CurrentHeaterPower)+';'+str(TotalHeaterConsumtion), 0)
-
-            decoder.skip_bytes(8)
-            TotalEnergyRecovered = decoder.decode_32bit_uint()  # reg[23-24] from byte[44]
-            UpdateDevice(self.UNITS['TotalEnergyRecovered'], 0, str(CurrentHeatRecovery)+';'+str(TotalEnergyRecovered), 0)
-
-            temperature = ConvertToFloat(MonitoringDataResult, 25+registersStartingOffset)
-            humidity = int(MonitoringDataResult.registers[26+registersStartingOffset])
-
-            UpdateDevice(self.UNITS['CurrentExchangeEfficiency'], 0, str(CurrentExchangeEfficiency), 0)
-            UpdateDevice(self.UNITS['CurrentEnergySaving'], 0, str(CurrentEnergySaving), 0)
-
-            UpdateDevice(self.UNITS['Temp'], 0, str(temperature), 0)
-            UpdateDevice(self.UNITS['Hum'], humidity, str(humidity), 0)
+        start = time.perf_counter()
+        for index, poller in enumerate(self.pollers):
+            values, version, online = poller.snapshot()
+            # Unchanged register blocks keep the version, the devices are only revisited once
+            # min_interval has passed to publish held back values and refreshes
+            if version == self.versions[index] and \
+                    (not online or time.monotonic() - self.updated[index] < self.options['min_interval']):
+                continue
+            self.versions[index] = version
+            self.updated[index] = time.monotonic()
+            if not online:
+                Domoticz.Error("Controller " + str(poller.session) + " unreachable, devices marked as timed out.")
+                self.MarkTimedOut(index * self.UNIT_STRIDE)
+                continue
+
+            if poller.ring is not None:
+                # Publish the average of the samples taken since the last heartbeat
+                now = time.time()
+                for name, (low, high, average) in poller.ring.aggregate(self.sampled[index]).items():
+                    values[name] = round(average, 1)
+                    if self.debug:
+                        Domoticz.Log(str(poller.session) + " " + name + " min/max: " + str(round(low, 1)) + "/" +
+                                     str(round(high, 1)))
+                self.sampled[index] = now
+            self.UpdateDevices(values, index * self.UNIT_STRIDE)
 
             if self.debug:
-                Domoticz.Log("CurrentPowerConsumption: " + str(CurrentPowerConsumption))
-                Domoticz.Log("CurrentHeaterPower: " + str(CurrentHeaterPower))
-                Domoticz.Log("CurrentHeatRecovery: " + str(CurrentHeatRecovery))
-                Domoticz.Log("CurrentExchangeEfficiency: " + str(CurrentExchangeEfficiency))
-                Domoticz.Log("CurrentEnergySaving: " + str(CurrentEnergySaving))
-                Domoticz.Log("CurrentEnergySaving: " + str(CurrentEnergySaving))
-                Domoticz.Log("TotalEnergyConsumtion: " + str(TotalEnergyConsumtion))
-                Domoticz.Log("TotalHeaterConsumtion: " + str(TotalHeaterConsumtion))
-                Domoticz.Log("TotalEnergyRecovered: " + str(TotalEnergyRecovered))
-                Domoticz.Log("Temperature: " + str(temperature))
-                Domoticz.Log("Humidity: " + str(humidity))
+                for name in sorted(values):
+                    Domoticz.Log(str(poller.session) + " " + name + ": " + str(values[name]))
+
+        if self.metrics is not None:
+            self.metrics.observe('heartbeat', time.perf_counter() - start)
+            if time.monotonic() - self.metrics_published >= self.METRICS_PERIOD:
+                self.PublishMetrics()
+
+    def MarkTimedOut(self, offset):
+        # One pass over the controller's devices while it is unreachable, the next
+        # successful poll republishes them with TimedOut=0
+        now = time.monotonic()
+        for unit in range(offset + 1, offset + self.UNIT_STRIDE):
+            if unit in Devices and unit % self.UNIT_STRIDE not in self.LOCAL_UNITS and not Devices[unit].TimedOut:
+                self.published[unit] = (Devices[unit].nValue, Devices[unit].sValue, 1, now)
+                UpdateDevice(unit, Devices[unit].nValue, Devices[unit].sValue, 1)
+
+    def PublishMetrics(self):
+        self.metrics_published = time.monotonic()
+        for unit, name, share in (('ModbusLatency', 'read_holding_registers', 0.9),
+                                  ('HeartbeatDuration', 'heartbeat', 0.9)):
+            value = self.metrics.percentile(name, share)
+            if value is not None:
+                self.PublishDevice(self.UNITS[unit], 0, str(round(value * 1000, 1)), 0)
+        error_rate = self.metrics.mean('errors')
+        if error_rate is not None:
+            self.PublishDevice(self.UNITS['ModbusErrorRate'], 0, str(round(error_rate * 100, 2)), 0)
+
+        try:
+            with open(self.options['metrics_file'], 'w') as f:
+                f.write(self.metrics.report())
+        except IOError as e:
+            Domoticz.Error("Unable to write metrics file: " + str(e))
+
+    def UpdateDevices(self, values, offset):
+        for point in REGISTER_MAP:
+            if point.unit is None or point.name not in values:
+                continue
+            value = values[point.name]
+            if point.unit in self.ENERGY_UNITS:
+                power = self.ENERGY_UNITS[point.unit]
+                if power not in values:
+                    continue
+                self.PublishDevice(offset + self.UNITS[point.unit], 0, str(values[power])+';'+str(value), 0)
+            elif point.unit in self.NVALUE_UNITS:
+                self.PublishDevice(offset + self.UNITS[point.unit], value, str(value), 0)
+            else:
+                self.PublishDevice(offset + self.UNITS[point.unit], 0, str(value), 0)
 
-        self.client.close()
+        if 'Mode' in values:
+            if values['Mode'] == 50:  # Kitchen
+                self.PublishDevice(offset + self.UNITS['Kitchen'], 5, str(5), 0)
+            elif values['Mode'] == 60:  # Fireplace
+                self.PublishDevice(offset + self.UNITS['Fireplace'], 5, str(5), 0)
+            else:
+                self.PublishDevice(offset + self.UNITS['Kitchen'], 0, str(0), 0)
+                self.PublishDevice(offset + self.UNITS['Fireplace'], 0, str(0), 0)
+
+    def PublishDevice(self, Unit, nValue, sValue, TimedOut, Force=False):
+        # Cuts Domoticz database writes of measured values: changes within the unit's deadband and
+        # changes sooner than min_interval after the last publish are held back, unless
+        # refresh_interval has passed. Commands publish with Force.
+        sValue = str(sValue)
+        now = time.monotonic()
+        deadband = self.deadbands.get(self.UNIT_NAMES.get(Unit % self.UNIT_STRIDE))
+        last = self.published.get(Unit)
+        refresh = False
+        if not Force and last is not None and last[2] == TimedOut:
+            if deadband is None:
+                if last[0] == nValue and last[1] == sValue:
+                    return
+            elif now - last[3] >= self.options['refresh_interval']:
+                refresh = True
+            elif now - last[3] < self.options['min_interval'] or WithinDeadband(last[1], sValue, deadband):
+                return
+        self.published[Unit] = (nValue, sValue, TimedOut, now)
+        UpdateDevice(Unit, nValue, sValue, TimedOut, AlwaysUpdate=refresh)
 
 
 global _plugin
@@ -423,23 +608,78 @@ def DumpConfigToLog():
             Domoticz.Debug( "'" + x + "':'" + str(Parameters[x]) + "'")
     Domoticz.Debug("Device count: " + str(len(Devices)))
     for x in Devices:
-        Domoticz.Debug("Device:           " + str(x) + " - " + str(Devices[x]))
-        Domoticz.Debug("Device ID:       '" + str(Devices[x].ID) + "'")
-        Domoticz.Debug("Device Name:     '" + Devices[x].Name + "'")
-        Domoticz.Debug("Device nValue:    " + str(Devices[x].nValue))
-        Domoticz.Debug("Device sValue:   '" + Devices[x].sValue + "'")
-        Domoticz.Debug("Device LastLevel: " + str(Devices[x].LastLevel))
+        Domoticz.Debug("Device " + str(x) + ": '" + Devices[x].Name + "' " + str(Devices[x].nValue) + " '" +
+                       Devices[x].sValue + "'")
     return
 
 
-def UpdateDevice(Unit, nValue, sValue, TimedOut):
+def ParseEndpoints(text, port):
+    # "host[:port], host[:port]" -> [(host, port)]
+    endpoints = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            host, item_port = item.rsplit(':', 1)
+            endpoints.append((host, int(item_port)))
+        else:
+            endpoints.append((item, port))
+    return endpoints
+
+
+def ParseDeadbands(text, defaults):
+    # "name:value,name:value/value" -> {name: [(limit, relative)]} with one band per sValue field,
+    # a value ending with % is relative
+    deadbands = {}
+    items = [(name, str(value)) for name, value in defaults.items()]
+    items += [item.split(':', 1) for item in text.split(',') if ':' in item]
+    for name, value in items:
+        value = value.strip()
+        try:
+            deadbands[name.strip()] = [(float(band.strip().rstrip('%')), band.strip().endswith('%'))
+                                       for band in value.split('/')]
+        except ValueError:
+            Domoticz.Error("Invalid deadband '" + value + "' for '" + name + "' ignored.")
+    return deadbands
+
+
+def WithinDeadband(old, new, deadband):
+    # Compares sValues field by field, fields beyond the last band use the last band
+    try:
+        pairs = list(zip([float(x) for x in old.split(';')], [float(x) for x in new.split(';')]))
+    except ValueError:
+        return False
+    for index, (a, b) in enumerate(pairs):
+        limit, relative = deadband[min(index, len(deadband) - 1)]
+        allowed = abs(a) * limit / 100 if relative else limit
+        if abs(b - a) > allowed + 1e-9:
+            return False
+    return True
+
+
+def ParseOptions(text, defaults):
+    # "key=value;key=value" -> dict, values cast to the type of their default
+    options = dict(defaults)
+    for item in text.split(';'):
+        if '=' not in item:
+            continue
+        key, value = [x.strip() for x in item.split('=', 1)]
+        if key not in defaults:
+            Domoticz.Error("Unknown option '" + key + "' ignored.")
+            continue
+        try:
+            options[key] = type(defaults[key])(value)
+        except ValueError:
+            Domoticz.Error("Invalid value '" + value + "' for option '" + key + "' ignored.")
+    return options
+
+
+def UpdateDevice(Unit, nValue, sValue, TimedOut, AlwaysUpdate=False):
     # Make sure that the Domoticz device still exists (they can be deleted) before updating it
     if Unit in Devices:
-        if Devices[Unit].nValue != nValue or Devices[Unit].sValue != sValue or Devices[Unit].TimedOut != TimedOut:
+        if Devices[Unit].nValue != nValue or Devices[Unit].sValue != sValue or Devices[Unit].TimedOut != TimedOut or AlwaysUpdate:
             Devices[Unit].Update(nValue=nValue, sValue=str(sValue), TimedOut=TimedOut)
             # Domoticz.Log("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+")")
     return
 
-
-def ConvertToFloat(data, reg):
-    return float(ctypes.c_short(data.registers[reg]).value) / 10
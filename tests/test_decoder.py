@@ -0,0 +1,100 @@
+# ReadPlan.decode against the decoding plugin.py used before the register map (ConvertToFloat and
+# BinaryPayloadDecoder over a 900+47 read)
+import ctypes
+import os
+import random
+import sys
+import unittest
+
+from pymodbus.constants import Endian
+from pymodbus.payload import BinaryPayloadDecoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from komfovent import ReadPlan, REGISTER_MAP
+
+
+def ConvertToFloat(registers, reg):
+    return float(ctypes.c_short(registers[reg]).value) / 10
+
+
+def legacy_monitoring(registers):
+    # registers of 900-946, decoded as in the original onHeartbeat
+    values = {
+        'SupplyTemp': ConvertToFloat(registers, 1),
+        'ExtractTemp': ConvertToFloat(registers, 2),
+        'OutdoorTemp': ConvertToFloat(registers, 3),
+        'WaterTemp': ConvertToFloat(registers, 4),
+        'SupplyFanIntensivity': ConvertToFloat(registers, 9),
+        'ExtractFanIntensivity': ConvertToFloat(registers, 10),
+        'HeatExchanger': ConvertToFloat(registers, 11),
+        'ElectricHeater': ConvertToFloat(registers, 12),
+        'WaterHeater': ConvertToFloat(registers, 13),
+        'WaterCooler': ConvertToFloat(registers, 14),
+        'DXUnit': ConvertToFloat(registers, 15),
+        'FiltersImupurity': float(registers[16]),
+        'CurrentPowerConsumption': int(registers[20]),
+        'CurrentHeaterPower': int(registers[21]),
+        'CurrentHeatRecovery': int(registers[22]),
+        'CurrentExchangeEfficiency': int(registers[23]),
+        'CurrentEnergySaving': int(registers[24]),
+        'Temp': ConvertToFloat(registers, 45),
+        'Hum': int(registers[46]),
+        }
+    decoder = BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.Big)
+    decoder.skip_bytes(6+17*2+5*4)
+    values['TotalEnergyConsumtion'] = decoder.decode_32bit_uint()
+    decoder.skip_bytes(8)
+    values['TotalHeaterConsumtion'] = decoder.decode_32bit_uint()
+    decoder.skip_bytes(8)
+    values['TotalEnergyRecovered'] = decoder.decode_32bit_uint()
+    return values
+
+
+class DecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = ReadPlan(REGISTER_MAP)
+        self.assertIn((901, 46), self.plan.blocks)
+
+    def assertLegacy(self, registers):
+        expected = legacy_monitoring(registers)
+        decoded = self.plan.decode(901, registers[1:])[0]
+        for name, value in expected.items():
+            self.assertEqual(decoded[name], value, name)
+            self.assertEqual(str(decoded[name]), str(value), name)
+
+    def test_negative_temperatures_and_large_totals(self):
+        registers = [0] * 47
+        registers[1] = 0x10000 - 5      # -0.5
+        registers[3] = 0x10000 - 123    # -12.3
+        registers[4] = 0x8000           # sensor missing, -3276.8
+        registers[45] = 0x10000 - 1     # -0.1
+        registers[9] = 653
+        registers[16] = 37
+        registers[46] = 41
+        registers[30:32] = [0x0001, 0x0000]   # 65536
+        registers[36:38] = [0x1234, 0xABCD]
+        registers[42:44] = [0xFFFF, 0xFFFF]
+        self.assertLegacy(registers)
+
+    def test_random_blocks(self):
+        generator = random.Random(1)
+        for i in range(500):
+            self.assertLegacy([generator.randrange(0x10000) for register in range(47)])
+
+    def test_unchanged_block(self):
+        registers = list(range(47))
+        first, changed = self.plan.decode(901, registers[1:])
+        self.assertTrue(changed)
+        again, changed = self.plan.decode(901, list(registers[1:]))
+        self.assertFalse(changed)
+        self.assertEqual(again, first)
+        registers[30] += 1
+        third, changed = self.plan.decode(901, registers[1:])
+        self.assertTrue(changed)
+        self.assertNotEqual(third['TotalEnergyConsumtion'], first['TotalEnergyConsumtion'])
+
+
+if __name__ == '__main__':
+    unittest.main()
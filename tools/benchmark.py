@@ -0,0 +1,123 @@
+# Offline benchmark of the plugin's heartbeat and command path against the C6 simulator
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from c6_simulator import C6Simulator
+from domoticz_harness import Harness, ROOT
+
+sys.path.insert(0, ROOT)
+import komfovent
+
+# Simulator settings per scenario
+SCENARIOS = {
+    'lan': {'latency': 0.002},
+    'wan': {'latency': 0.05, 'jitter': 0.05},
+    'pipelined': {'latency': 0.05, 'jitter': 0.05, 'pipelining': 'parallel'},
+    'faults': {'latency': 0.005, 'error_rate': 0.05, 'drop_rate': 0.02},
+    'commands': {'latency': 0.01},
+    }
+
+
+def percentile(samples, share):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(share * len(samples)))]
+
+
+def scaled_intervals(scale):
+    return ','.join('%s:%g-%g' % (group, low * scale, high * scale)
+                    for group, (low, high) in sorted(komfovent.POLL_INTERVALS.items()))
+
+
+def timed_poll(poller, samples):
+    # Times the poller's cycles that talked to the controller
+    poll = poller.poll
+
+    def wrapper():
+        reads = poller.reads
+        start = time.perf_counter()
+        try:
+            return poll()
+        finally:
+            if poller.reads != reads:
+                samples.append(time.perf_counter() - start)
+    poller.poll = wrapper
+
+
+def run(name, cycles, heartbeat, scale, extra_options=''):
+    simulator = C6Simulator(noise=True, seed=1, **SCENARIOS[name]).start()
+    options = 'timeout=0.5;intervals=' + scaled_intervals(scale)
+    options += ';min_interval=%g;refresh_interval=%g' % (30 * scale, 900 * scale)
+    if extra_options:
+        options += ';' + extra_options
+    harness = Harness({'Address': '%s:%d' % simulator.address, 'Mode1': options, 'Mode5': 'true'})
+    plugin = harness.plugin
+
+    plugin.onStart()
+    poll_times = []
+    for poller in plugin._plugin.pollers:
+        timed_poll(poller, poll_times)
+    time.sleep(heartbeat)
+    plugin.onHeartbeat()
+
+    heartbeat_times, command_times, transactions, updates = [], [], [], []
+    for cycle in range(cycles):
+        simulator.reset_counters()
+        before = harness.updates()
+        if name == 'commands':
+            # Drag the kitchen dimmer and toggle ECO during the cycle
+            for level in range(0, 101, 10):
+                start = time.perf_counter()
+                plugin.onCommand(plugin._plugin.UNITS['Kitchen'], 'Set Level', level, 0)
+                command_times.append(time.perf_counter() - start)
+            plugin.onCommand(plugin._plugin.UNITS['ECO'], 'On' if cycle % 2 else 'Off', 0, 0)
+        time.sleep(heartbeat)
+        start = time.perf_counter()
+        plugin.onHeartbeat()
+        heartbeat_times.append(time.perf_counter() - start)
+        transactions.append(simulator.counters['transactions'])
+        updates.append(harness.updates() - before)
+
+    plugin.onStop()
+    simulator.stop()
+
+    report = {
+        'scenario': name,
+        'heartbeat p50 ms': percentile(heartbeat_times, 0.5) * 1000,
+        'heartbeat max ms': max(heartbeat_times) * 1000,
+        'poll p50 ms': percentile(poll_times, 0.5) * 1000,
+        'poll p95 ms': percentile(poll_times, 0.95) * 1000,
+        'transactions/cycle': sum(transactions) / float(cycles),
+        'updates/cycle': sum(updates) / float(cycles),
+        'errors': len(harness.errors()),
+        }
+    if command_times:
+        report['command p95 ms'] = percentile(command_times, 0.95) * 1000
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark plugin.py against the C6 simulator')
+    parser.add_argument('scenarios', nargs='*', help='any of ' + ', '.join(sorted(SCENARIOS)) + ' (default all)')
+    parser.add_argument('--cycles', type=int, default=20, help='heartbeats per scenario')
+    parser.add_argument('--heartbeat', type=float, default=1.0, help='seconds between heartbeats')
+    parser.add_argument('--scale', type=float, default=0.1, help='factor applied to poll and publish intervals')
+    parser.add_argument('--options', default='', help='extra plugin options')
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario ' + name)
+
+    for name in args.scenarios or sorted(SCENARIOS):
+        report = run(name, args.cycles, args.heartbeat, args.scale, args.options)
+        print('  '.join('%s: %s' % (key, ('%.2f' % value) if isinstance(value, float) else value)
+                        for key, value in report.items()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
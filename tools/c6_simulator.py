@@ -0,0 +1,241 @@
+# Local Modbus TCP simulator of the Komfovent C6 registers used by the plugin
+import argparse
+import datetime
+import os
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from komfovent import ThreadingTCPServer
+
+# Register values of a unit in normal mode, temperatures and intensities in 0.1 units
+DEFAULT_REGISTERS = {
+    0: 1,       # on/off
+    2: 0,       # eco
+    3: 0,       # auto
+    4: 3,       # mode: normal
+    10: 2,      # temperature control: extract
+    901: 195,   # supply temperature
+    902: 221,   # extract temperature
+    903: 45,    # outdoor temperature
+    904: 0,     # water temperature
+    909: 420,   # supply fan intensity
+    910: 410,   # extract fan intensity
+    911: 830,   # heat exchanger
+    912: 0,     # electric heater
+    913: 0,     # water heater
+    914: 0,     # water cooler
+    915: 0,     # DX unit
+    916: 37,    # filters impurity
+    920: 61,    # current power consumption
+    921: 0,     # current heater power
+    922: 640,   # current heat recovery
+    923: 84,    # heat exchanger efficiency
+    924: 91,    # energy saving
+    930: 0, 931: 48211,     # total energy consumption
+    936: 0, 937: 3102,      # total heater consumption
+    942: 5, 943: 1337,      # total energy recovered
+    945: 221,   # panel temperature
+    946: 41,    # panel humidity
+    5130: 0,    # kitchen
+    5137: 0,    # fireplace
+    }
+
+# Registers drifting by one step on every read when noise is enabled
+NOISY_REGISTERS = (901, 902, 903, 909, 910, 911, 920, 922, 945, 946)
+
+
+class C6Simulator:
+    # Threaded Modbus TCP server answering function codes 3, 6 and 16. Every answer can be delayed by
+    # latency + uniform(0, jitter) seconds, error_rate answers with a slave failure exception and
+    # drop_rate leaves a request unanswered. Setting offline makes the unit refuse all connections.
+    # Requests sent back to back are answered one after another with pipelining 'queue', each after
+    # its own delay with 'parallel', and lost while the unit is busy with 'none'.
+
+    PIPELINING = ('queue', 'parallel', 'none')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, drop_rate=0.0,
+                 noise=False, seed=None, pipelining='queue'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.noise = noise
+        self.pipelining = pipelining
+        self.offline = False
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.registers = dict(DEFAULT_REGISTERS)
+        self.set_clock(datetime.datetime.now())
+        self.counters = {'transactions': 0, 'reads': 0, 'writes': 0, 'errors': 0, 'dropped': 0, 'connections': 0}
+
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                simulator.serve(self.request)
+
+        self.server = ThreadingTCPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def set_clock(self, now):
+        with self.lock:
+            self.registers[28] = now.hour << 8 | now.minute
+            self.registers[29] = now.year
+            self.registers[30] = now.month << 8 | now.day
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='C6 simulator', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            for key in self.counters:
+                self.counters[key] = 0
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def serve(self, connection):
+        if self.offline:
+            connection.close()
+            return
+        self.count('connections')
+        send_lock = threading.Lock()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while not self.offline:
+            header = _receive(connection, 7)
+            if header is None:
+                return
+            tid, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = _receive(connection, length - 1)
+            if pdu is None:
+                return
+            self.count('transactions')
+            response = self.execute(pdu)
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if response is None:
+                self.count('dropped')
+                continue
+            frame = struct.pack('>HHHB', tid, protocol, len(response) + 1, unit) + response
+            if self.pipelining == 'parallel':
+                timer = threading.Timer(delay, self.answer, (connection, send_lock, frame))
+                timer.daemon = True
+                timer.start()
+                continue
+            if delay:
+                time.sleep(delay)
+            if not self.answer(connection, send_lock, frame):
+                return
+            if self.pipelining == 'none':
+                self.discard(connection)
+
+    def answer(self, connection, send_lock, frame):
+        with send_lock:
+            try:
+                connection.sendall(frame)
+            except OSError:
+                return False
+        return True
+
+    def discard(self, connection):
+        # Requests that arrived while the unit was busy are lost
+        connection.setblocking(False)
+        try:
+            while connection.recv(4096):
+                self.count('dropped')
+        except OSError:
+            pass
+        finally:
+            connection.setblocking(True)
+
+    def execute(self, pdu):
+        function = pdu[0]
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            return None
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.count('errors')
+            return struct.pack('>BB', function | 0x80, 4)
+
+        with self.lock:
+            if function == 3:
+                address, count = struct.unpack('>HH', pdu[1:5])
+                self.counters['reads'] += 1
+                values = [self.read(a) for a in range(address, address + count)]
+                return struct.pack('>BB%dH' % count, function, count * 2, *values)
+            if function == 6:
+                address, value = struct.unpack('>HH', pdu[1:5])
+                self.counters['writes'] += 1
+                self.registers[address] = value
+                return pdu[:5]
+            if function == 16:
+                address, count, size = struct.unpack('>HHB', pdu[1:6])
+                self.counters['writes'] += 1
+                for index, value in enumerate(struct.unpack('>%dH' % count, pdu[6:6 + size])):
+                    self.registers[address + index] = value
+                return pdu[:5]
+        return struct.pack('>BB', function | 0x80, 1)
+
+    def read(self, address):
+        value = self.registers.get(address, 0)
+        if self.noise and address in NOISY_REGISTERS:
+            value = max(0, value + self.random.choice((-1, 0, 1)))
+            self.registers[address] = value
+        return value
+
+
+def _receive(connection, size):
+    data = b''
+    while len(data) < size:
+        try:
+            chunk = connection.recv(size - len(data))
+        except OSError:
+            return None
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Komfovent C6 Modbus TCP simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added on top of latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of exception answers')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='share of unanswered requests')
+    parser.add_argument('--noise', action='store_true', help='let measured values drift')
+    parser.add_argument('--pipelining', choices=C6Simulator.PIPELINING, default='queue',
+                        help='handling of requests sent back to back')
+    args = parser.parse_args(argv)
+
+    simulator = C6Simulator(args.host, args.port, args.latency, args.jitter, args.error_rate, args.drop_rate,
+                            args.noise, pipelining=args.pipelining).start()
+    print('C6 simulator listening on %s:%d' % simulator.address)
+    try:
+        while True:
+            time.sleep(60)
+            print(simulator.counters)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
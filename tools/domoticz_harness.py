@@ -0,0 +1,97 @@
+# Stand-in for the Domoticz Python plugin framework, runs plugin.py outside of Domoticz
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PARAMETERS = {
+    'Address': '127.0.0.1',
+    'Port': '502',
+    'Mode1': '',
+    'Mode5': 'false',
+    'Mode6': 'false',
+    'HomeFolder': tempfile.gettempdir() + os.sep,
+    'HardwareID': 1,
+    'Key': 'DOMEKT',
+    'Name': 'Domekt',
+    }
+
+
+class Device:
+    # Subset of Domoticz.Device used by the plugin, counts the updates it receives
+
+    registry = None
+
+    def __init__(self, Name, Unit, TypeName='', Type=0, Subtype=0, Image=0, Options=None, Used=0, **kwargs):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ''
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.updates = 0
+
+    def __str__(self):
+        return self.Name
+
+    def Create(self):
+        Device.registry[self.Unit] = self
+
+    def Delete(self):
+        Device.registry.pop(self.Unit, None)
+
+    def Update(self, nValue, sValue, TimedOut=0, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+        self.updates += 1
+
+
+class Harness:
+    # Loads plugin.py with a fake Domoticz module. Messages logged by the plugin are kept in log.
+
+    def __init__(self, parameters=None, echo=False):
+        self.log = []
+        self.echo = echo
+        self.devices = {}
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.parameters.update(parameters or {})
+
+        Device.registry = self.devices
+        domoticz = types.ModuleType('Domoticz')
+        domoticz.Device = Device
+        domoticz.Log = lambda message: self.message('Log', message)
+        domoticz.Status = lambda message: self.message('Status', message)
+        domoticz.Error = lambda message: self.message('Error', message)
+        domoticz.Debug = lambda message: self.message('Debug', message)
+        domoticz.Debugging = lambda level: None
+        domoticz.Heartbeat = lambda seconds: None
+        sys.modules['Domoticz'] = domoticz
+
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        sys.modules.pop('plugin', None)
+        import plugin
+        plugin.Parameters = self.parameters
+        plugin.Devices = self.devices
+        self.plugin = plugin
+
+    def message(self, level, message):
+        self.log.append((level, message))
+        if self.echo:
+            print(level + ': ' + message)
+
+    def errors(self):
+        return [message for level, message in self.log if level == 'Error']
+
+    def updates(self):
+        return sum(device.updates for device in self.devices.values())
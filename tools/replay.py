@@ -0,0 +1,45 @@
+# Plays a frame capture (plugin option capture=<file>) through the plugin's decode and device update path
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from domoticz_harness import Harness
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a C6 frame capture through plugin.py without Modbus')
+    parser.add_argument('capture', help='file written by the capture option')
+    parser.add_argument('--options', default='min_interval=0',
+                        help='extra plugin options, publish rate limits are off by default')
+    parser.add_argument('--dump', action='store_true', help='print the device states after every poll as JSON')
+    args = parser.parse_args(argv)
+
+    harness = Harness({'Mode1': 'replay=' + args.capture + ';' + args.options})
+    plugin = harness.plugin
+    plugin.onStart()
+    source = plugin._plugin.pollers[0]
+
+    cycles = 0
+    elapsed = 0.0
+    while not source.done:
+        start = time.perf_counter()
+        plugin.onHeartbeat()
+        elapsed += time.perf_counter() - start
+        cycles += 1
+        if args.dump:
+            print(json.dumps(dict((unit, [device.nValue, device.sValue, device.TimedOut])
+                                  for unit, device in sorted(harness.devices.items()))))
+    plugin.onStop()
+
+    for message in harness.errors():
+        print('Error: ' + message, file=sys.stderr)
+    print('%d frames in %d polls, %.1f us per poll, %d device updates' %
+          (source.frames, cycles, elapsed / max(cycles, 1) * 1e6, harness.updates()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())